@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""micro benchmark of ndrop packet parser.
+
+$ python3 benchmark.py dukto --size 256
+$ python3 benchmark.py nitroshare --size 256
+$ python3 benchmark.py nitroshare-send --size 256
+$ python3 benchmark.py small-files --size 20 --count 20000
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import argparse
+
+from ndrop import dukto
+from ndrop import nitroshare
+from ndrop.netdrop import NetDropClient
+from ndrop.transport import RecvBuffer, CHUNK_SIZE, human_size
+
+
+RECV_SIZES = [1024 * 4, 1024 * 16, 1024 * 64, 1024 * 256, 1024 * 1024]
+
+
+class NullAgent(object):
+    """drop all data, only count"""
+    recv_size = 0
+    _read_size = CHUNK_SIZE
+
+    def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        pass
+
+    def send_feed_files(self, files, total_send_size, total_size):
+        pass
+
+    def send_finish_file(self, path):
+        pass
+
+    def send_finish(self, err):
+        pass
+
+    def file_changed(self, name, size, new_size):
+        return 'truncate'
+
+    def recv_feed_file(self, path, data, recv_size, file_size, total_recv_size, total_size, from_addr):
+        if isinstance(data, list):
+            self.recv_size += sum(len(chunk) for chunk in data)
+        elif data:
+            self.recv_size += len(data)
+
+    def recv_finish_file(self, path, from_addr):
+        pass
+
+
+def make_files(tmp_dir, size, count):
+    files = []
+    file_size = size // count
+    chunk = os.urandom(min(file_size, 1024 * 1024))
+    for x in range(count):
+        path = os.path.join(tmp_dir, 'bench_%s.bin' % x)
+        if not os.path.exists(path) or os.path.getsize(path) != file_size:
+            with open(path, 'wb') as f:
+                left = file_size
+                while left > 0:
+                    left -= f.write(chunk[:left])
+        files.append((path, os.path.basename(path), file_size))
+    return files
+
+
+def dukto_stream(files):
+    packet = dukto.DuktoPacket()
+    total_size = sum(size for _, _, size in files)
+    data = bytearray(packet.pack_files_header(len(files), total_size))
+    for chunk in packet.pack_files(NullAgent(), total_size, files):
+        data.extend(chunk)
+    return bytes(data)
+
+
+def nitroshare_stream(files):
+    packet = nitroshare.Packet()
+    total_size = sum(size for _, _, size in files)
+    data = bytearray(packet.pack_files_header('bench', total_size, len(files)))
+    for chunk in packet.pack_files(NullAgent(), total_size, files):
+        data.extend(chunk)
+    return bytes(data)
+
+
+def bench_parser(name, stream, packet_class, recv_size, total_size):
+    agent = NullAgent()
+    packet = packet_class()
+    buff = RecvBuffer()
+    view = memoryview(stream)
+    start = time.perf_counter()
+    for pos in range(0, len(stream), recv_size):
+        buff.extend(view[pos:pos + recv_size])
+        packet.unpack_tcp(agent, buff, ('127.0.0.1', 0))
+    elapsed = time.perf_counter() - start
+    assert agent.recv_size == total_size, (agent.recv_size, total_size)
+    print('%-12s recv %8s: %10s/s' % (name, human_size(recv_size), human_size(len(stream) / elapsed)))
+
+
+def drain(sock):
+    buff = bytearray(1024 * 1024)
+    while sock.recv_into(buff):
+        pass
+
+
+def bench_sender(name, send, total_size, count=None):
+    sock, peer = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(peer,))
+    reader.start()
+    start = time.perf_counter()
+    send(sock)
+    sock.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    sock.close()
+    peer.close()
+    if count:
+        print('%-12s send: %10s/s, %8d files/s' % (
+            name, human_size(total_size / elapsed), count / elapsed))
+    else:
+        print('%-12s send: %10s/s' % (name, human_size(total_size / elapsed)))
+
+
+def nitroshare_send(files, total_size):
+    agent = NullAgent()
+    client = nitroshare.NitroshareClient(agent, '127.0.0.1')
+
+    def send_generator(sock):
+        for chunk in client._packet.pack_files(client, total_size, files):
+            sock.sendall(chunk)
+
+    def send_sendmsg(sock):
+        client.sendmsg_files(sock, total_size, files)
+
+    bench_sender('generator', send_generator, total_size)
+    bench_sender('sendmsg', send_sendmsg, total_size)
+
+
+def small_files_send(files, total_size, callback=False):
+    if callback:    # md5 and process bar of NetDropClient
+        agent = NetDropClient('127.0.0.1', mode='dukto')
+        agent._bar = agent.init_bar(total_size * 4)
+    else:
+        agent = NullAgent()
+    dukto_client = dukto.DuktoClient(agent, '127.0.0.1')
+    nitroshare_client = nitroshare.NitroshareClient(agent, '127.0.0.1')
+
+    def send_dukto_generator(sock):
+        for chunk in dukto_client._packet.pack_files(dukto_client, total_size, files):
+            sock.sendall(chunk)
+
+    def send_dukto(sock):
+        dukto_client.sendfile_files(sock, total_size, files)
+
+    def send_nitroshare_generator(sock):
+        for chunk in nitroshare_client._packet.pack_files(nitroshare_client, total_size, files):
+            sock.sendall(chunk)
+
+    def send_nitroshare(sock):
+        nitroshare_client.sendmsg_files(sock, total_size, files)
+
+    bench_sender('dukto gen', send_dukto_generator, total_size, len(files))
+    bench_sender('dukto', send_dukto, total_size, len(files))
+    bench_sender('nitro gen', send_nitroshare_generator, total_size, len(files))
+    bench_sender('nitroshare', send_nitroshare, total_size, len(files))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='ndrop micro benchmark')
+    parser.add_argument('bench', choices=['dukto', 'nitroshare', 'nitroshare-send', 'small-files'], help='benchmark')
+    parser.add_argument('--size', type=int, default=256, help='total size in MB. default: 256')
+    parser.add_argument('--count', type=int, default=16, help='file count. default: 16')
+    parser.add_argument('--callback', action='store_true',
+                        help='run md5 and process bar of client. output to stderr')
+    parser.add_argument('--tmp', default='/tmp', help='directory for test files. default: /tmp')
+    args = parser.parse_args()
+
+    if args.bench == 'small-files':
+        args.tmp = os.path.join(args.tmp, 'ndrop_small_files')
+        os.makedirs(args.tmp, exist_ok=True)
+    files = make_files(args.tmp, args.size * 1024 * 1024, args.count)
+    total_size = sum(size for _, _, size in files)
+    if args.bench == 'dukto':
+        stream = dukto_stream(files)
+        for recv_size in RECV_SIZES:
+            bench_parser('dukto', stream, dukto.DuktoPacket, recv_size, total_size)
+    elif args.bench == 'nitroshare':
+        stream = nitroshare_stream(files)
+        for recv_size in RECV_SIZES:
+            bench_parser('nitroshare', stream, nitroshare.Packet, recv_size, total_size)
+    elif args.bench == 'nitroshare-send':
+        nitroshare_send(files, total_size)
+    elif args.bench == 'small-files':
+        small_files_send(files, total_size, args.callback)
+
+
+if __name__ == '__main__':
+    sys.exit(run())
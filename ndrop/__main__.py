@@ -10,6 +10,9 @@ import glob
 from . import about
 from . import hfs
 from .netdrop import NetDropServer, NetDropClient
+from .transport import parse_size, CHANGE_POLICIES
+from .digest import ALGORITHMS, SUM_FILES
+from .verify import verify_manifest
 
 
 logger = logging.getLogger(__name__)
@@ -42,8 +45,36 @@ def run():
                        help='listen on...')
 
     group.add_argument('--send',
-                       metavar='<ip[:port]>',
-                       help='send to...')
+                       metavar='<ip[:port][@mode]>',
+                       help='send to... multiple destinations are separated by ",",'
+                       ' e.g. "192.168.1.2,192.168.1.3:40818@nitroshare"')
+
+    group.add_argument('--workers', type=int,
+                       metavar='<num>',
+                       help='receive from <num> connections at once. default: 32.')
+
+    group.add_argument('--engine', choices=['threading', 'asyncio'],
+                       metavar='<engine>',
+                       help='receive engine: [threading, asyncio]. default: threading.')
+
+    group.add_argument('--streams', type=int,
+                       metavar='<num>',
+                       help='send with <num> connections at once. default: 1.')
+
+    group.add_argument('--read-size', type=parse_size,
+                       metavar='<size>',
+                       help='read file with <size> when send, e.g. 64K, 1M. default: 64K.')
+
+    group.add_argument('--recv-size', type=parse_size,
+                       metavar='<size>',
+                       help='receive socket with <size>, e.g. 256K, 1M. default: 256K.')
+
+    group.add_argument('--sock-buf', type=parse_size,
+                       metavar='<size>',
+                       help='socket send/receive buffer size. default: system.')
+
+    group.add_argument('--auto-tune', action='store_true',
+                       help='adjust read/receive size by throughput.')
 
     parser.add_argument(
         'param', nargs='*',
@@ -68,6 +99,67 @@ def run():
                        help='sent FILE with "dukto" or "nitroshare" mode.'
                        ' "PARAM" is files')
 
+    group.add_argument('--files-from',
+                       metavar='<file>',
+                       help='sent files listed in <file> with NUL separator, "-" is stdin.'
+                       ' e.g. "find . -print0". directory is not walked')
+
+    group.add_argument('--spool-size', type=parse_size,
+                       metavar='<size>',
+                       help='"-" in PARAM is stdin, it is spooled to a temporary file'
+                       ' at most <size> before send. default: 4G.')
+
+    group.add_argument('--stdin-name',
+                       metavar='<name>',
+                       help='file name of stdin on receiver. default: stdin.')
+
+    group.add_argument('--compress',
+                       action='store_true',
+                       help='compress file data if receiver is ndrop, ask it on UDP port.'
+                       ' e.g. "--send <ip>:<tcp port>:<udp port>"')
+
+    group.add_argument('--resume',
+                       action='store_true',
+                       help='send rest of partial files left by broken transfer,'
+                       ' if receiver is ndrop. ask it on UDP port same as "--compress"')
+
+    group.add_argument('--dedup',
+                       action='store_true',
+                       help='don\'t send files which are in drop directory of ndrop receiver,'
+                       ' send hard links and duplicate files once. ask it on UDP port same as "--compress"')
+
+    group.add_argument('--hash', choices=ALGORITHMS,
+                       metavar='<hash>',
+                       help='hash of file data: [%s]. default: md5.'
+                       ' it is computed in thread' % ', '.join(ALGORITHMS))
+
+    group.add_argument('--checksum',
+                       action='store_true',
+                       help='sender: send digests of files to ndrop receiver to check them.'
+                       ' receiver: write digests of received files to %s in drop directory'
+                       % ', '.join(SUM_FILES.values()))
+
+    group.add_argument('--verify',
+                       metavar='<manifest>',
+                       help='hash files in checksum file again, e.g. MD5SUMS written by "--checksum".'
+                       ' file name is relative to directory of <manifest>. hash is "--hash",'
+                       ' else header or name of <manifest>')
+
+    group.add_argument('--io-depth', type=int,
+                       metavar='<num>',
+                       help='"--verify" reads <num> files at once. default: 1 for rotational disk,'
+                       ' else number of CPU.')
+
+    group.add_argument('--on-change', choices=CHANGE_POLICIES,
+                       metavar='<policy>',
+                       help='file is changed when send: [%s]. default: truncate.'
+                       ' "snapshot" clones files before send' % ', '.join(CHANGE_POLICIES))
+
+    group.add_argument('--snapshot-dir',
+                       metavar='<dir>',
+                       help='create snapshot of "--on-change snapshot" in <dir>, it should be on same'
+                       ' file system as sent files. default: parent directory of sent files')
+
     group.add_argument('--text',
                        action='store_true',
                        help='sent TEXT with "dukto" mode.'
@@ -95,17 +187,45 @@ def run():
     handler.setFormatter(logging.Formatter(fmt=FORMAT))
     app_logger.addHandler(handler)
 
+    io_size = {
+        'read_size': args.read_size,
+        'recv_size': args.recv_size,
+        'sock_buf_size': args.sock_buf,
+        'auto_tune': args.auto_tune,
+    }
+
     print(about.banner)
+    if args.verify:
+        try:
+            failed = verify_manifest(args.verify, algorithm=args.hash, depth=args.io_depth)
+        except (OSError, ValueError) as err:
+            logger.error(err)
+            sys.exit(2)
+        if failed:
+            sys.exit(1)
+        return
     if args.send:
         mode = args.mode or 'dukto'
-        client = NetDropClient(args.send, mode=mode, ssl_ck=(args.cert, args.key))
+        client = NetDropClient(
+            args.send, mode=mode, ssl_ck=(args.cert, args.key), io_size=io_size,
+            streams=args.streams, change_policy=args.on_change,
+            spool_size=args.spool_size, stdin_name=args.stdin_name,
+            compress=args.compress, resume=args.resume, dedup=args.dedup,
+            algorithm=args.hash, checksum=args.checksum, snapshot_dir=args.snapshot_dir)
         if args.text:
             client.send_text(' '.join(args.param))
+        elif args.files_from:
+            client.send_files_from(args.files_from)
         else:
             params = []
             for p in args.param:
-                params.extend(glob.glob(p))
+                if p == '-':    # stdin
+                    params.append(p)
+                else:
+                    params.extend(glob.glob(p))
             client.send_files(params)
+        if client.failed():
+            sys.exit(1)
         return
 
     if args.listen:
@@ -123,7 +243,10 @@ def run():
         hfs.start(listen, root_path=saved_dir, cert=args.cert, key=args.key)
     else:
         logger.info('File Transfer Server start (Press CTRL+C to quit)')
-        server = NetDropServer(listen, mode=args.mode, ssl_ck=(args.cert, args.key))
+        server = NetDropServer(
+            listen, mode=args.mode, ssl_ck=(args.cert, args.key),
+            max_workers=args.workers, engine=args.engine, io_size=io_size,
+            algorithm=args.hash, checksum=args.checksum)
         server.saved_to(saved_dir)
         server.wait_for_request()
 
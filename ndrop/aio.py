@@ -0,0 +1,209 @@
+import asyncio
+import functools
+import logging
+
+from . import dukto
+from . import nitroshare
+from .transport import BUFFER_POOL, FEATURE_QUERY
+from .extension import unwrap_packet
+from .compress import CompressedPacket
+
+
+logger = logging.getLogger(__name__)
+
+
+TCP_TIMEOUT = 20
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """discovery datagram, same as UDPHandler"""
+    def __init__(self, agent, packet):
+        self.agent = agent
+        self._packet = packet
+
+    def datagram_received(self, data, client_address):
+        if data == FEATURE_QUERY:
+            self.agent.say_features(client_address)
+        elif client_address[0] not in self.agent._ip_addrs:
+            try:
+                self._packet.unpack_udp(self.agent, bytearray(data), client_address)
+            except Exception as err:
+                logger.error('[%s] %s:%s %s' % (self.agent._name, *client_address[:2], err))
+
+
+class StreamProtocol(asyncio.BufferedProtocol):
+    """one TCP connection, same as TCPHandler.
+
+    Packet is parsed and file is written in worker pool of TCP server, and
+    reading is paused until worker returns, so event loop never blocks on
+    disk, hash or lock.
+    """
+    packet_class = None
+
+    def __init__(self, agent):
+        self.agent = agent
+        self._packet = self.packet_class()
+        self._recv_buff = BUFFER_POOL.get()
+        self._tuner = agent.create_tuner(agent._recv_size)
+        self._executor = agent._tcp_server._executor
+        self._loop = None
+        self._transport = None
+        self._timer = None
+        self._busy = False
+        self._closing = None    # error when connection is closed in worker
+        self._finished = False
+        self._unwrapped = False
+        self.client_address = None
+
+    def connection_made(self, transport):
+        self._loop = asyncio.get_running_loop()
+        self._transport = transport
+        self.client_address = transport.get_extra_info('peername')[:2]
+        logger.info('[%s] connect from %s:%s' % (self.agent._name, *self.client_address))
+        self._timer = self._loop.call_later(TCP_TIMEOUT, self.timeout)
+
+    def get_buffer(self, sizehint):
+        return self._recv_buff.room(self._tuner.size)
+
+    def buffer_updated(self, nbytes):
+        # time in worker isn't timeout of peer
+        self._timer.cancel()
+        self._recv_buff.advance(nbytes)
+        self._tuner.update(nbytes)
+        self._transport.pause_reading()
+        self._busy = True
+        future = self._loop.run_in_executor(self._executor, self.unpack)
+        future.add_done_callback(self.unpacked)
+
+    def unpack(self):
+        """run in worker, return True if transfer complete"""
+        if not self._unwrapped:
+            # stream of ndrop sender may be compressed or control request,
+            # compressed frames are parsed in thread of packet when socket is readable
+            packet = unwrap_packet(self._packet, self._recv_buff,
+                                   sock=self._transport.get_extra_info('socket'), send=self.write)
+            if packet is None:
+                return None
+            self._unwrapped = True
+            self._packet = packet
+        return self._packet.unpack_tcp(self.agent, self._recv_buff, self.client_address)
+
+    def write(self, data):
+        """reply of worker, written by event loop"""
+        if self._transport.is_closing():
+            raise ConnectionError('Connection closed by peer')
+        self._loop.call_soon_threadsafe(self._transport.write, bytes(data))
+
+    def unpacked(self, future):
+        self._busy = False
+        try:
+            ret = future.result()
+        except Exception as err:
+            logger.error('%s' % err)
+            self.finish(err)
+            return
+        if ret:
+            self.transfer_done()
+            self.finish('done')
+        elif self._closing is not None:
+            self.finish(self._closing)
+        else:
+            self._timer = self._loop.call_later(TCP_TIMEOUT, self.timeout)
+            self._transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.finish('abort')
+
+    def timeout(self):
+        logger.error('timed out')
+        self.finish('timed out')
+
+    def transfer_done(self):
+        pass
+
+    def finish(self, err):
+        if self._finished:
+            return
+        if self._busy:
+            # packet is used by worker, finish when it returns
+            if self._closing is None:
+                self._closing = err
+            return
+        self._finished = True
+        self._timer.cancel()
+        future = self._loop.run_in_executor(self._executor, self.teardown, err)
+        future.add_done_callback(self.closed)
+
+    def teardown(self, err):
+        """run in worker, same as TCPHandler.finish"""
+        try:
+            if isinstance(self._packet, CompressedPacket):
+                # sender closes connection after last frame
+                if err == 'abort' and self._packet.wait():
+                    err = 'done'
+                self._packet.close()
+            if err != 'done' and self._packet.in_file():
+                # reset, timeout or error, truncate and journal part file
+                self.agent.recv_finish_file(self._packet._filename, self.client_address)
+        finally:
+            self.agent.recv_finish(self.client_address, err)
+
+    def closed(self, future):
+        if future.exception() is not None:
+            logger.error('%s' % future.exception())
+        self._transport.close()
+        BUFFER_POOL.put(self._recv_buff)
+
+
+class DuktoProtocol(StreamProtocol):
+    packet_class = dukto.DuktoPacket
+
+
+class NitroshareProtocol(StreamProtocol):
+    packet_class = nitroshare.Packet
+
+    def transfer_done(self):
+        self._transport.write(self._packet.pack_success())
+
+
+PROTOCOLS = {
+    dukto.DuktoServer: DuktoProtocol,
+    nitroshare.NitroshareServer: NitroshareProtocol,
+}
+
+
+class AsyncioEngine(object):
+    """serve discovery and transfer of all transports in one event loop"""
+    _transports = None
+
+    def __init__(self, transports):
+        self._transports = transports
+
+    async def loop_say_hello(self, transport):
+        while transport._loop_hello:
+            transport.hello()
+            await asyncio.sleep(transport._hello_interval)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        servers = []
+        tasks = []
+        for transport in self._transports:
+            protocol_class = PROTOCOLS[type(transport)]
+            await loop.create_datagram_endpoint(
+                functools.partial(DatagramProtocol, transport, protocol_class.packet_class()),
+                sock=transport._udp_server.socket,
+            )
+            server = await loop.create_server(
+                functools.partial(protocol_class, transport),
+                sock=transport._tcp_server.socket,
+                ssl=transport._ssl_context,
+            )
+            servers.append(server)
+            tasks.append(loop.create_task(self.loop_say_hello(transport)))
+            transport.show_listen()
+        await asyncio.gather(*(server.serve_forever() for server in servers), *tasks)
+
+
+def serve(transports):
+    asyncio.run(AsyncioEngine(transports).serve())
@@ -0,0 +1,152 @@
+import zlib
+import select
+import struct
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .transport import RecvBuffer
+
+
+logger = logging.getLogger(__name__)
+
+
+# name in ndrop extensions
+FEATURE = 'zlib'
+# first bytes of compressed stream. As Dukto record count or NitroShare
+# frame size it is too large, so it is never sent by stock peers
+MAGIC = b'NDROPZ\x00\x01'
+# codec, size
+FRAME = struct.Struct('<BL')
+RAW = 0
+ZLIB = 1
+LEVEL = 1
+# compress file if sample of first chunk is less than 90%
+SAMPLE_SIZE = 1024 * 64
+MIN_RATIO = 0.9
+# frames compressed in thread and not sent yet
+MAX_PENDING = 8
+
+
+def compressible(data):
+    sample = data[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, LEVEL)) < len(sample) * MIN_RATIO
+
+
+def pack_frame(data, compress):
+    """return (header, payload)"""
+    if compress:
+        payload = zlib.compress(data, LEVEL)
+        if len(payload) < len(data):
+            return FRAME.pack(ZLIB, len(payload)), payload
+    return FRAME.pack(RAW, len(data)), data
+
+
+class CompressWriter(object):
+    """write data to socket in frames, compress them in thread.
+
+    Compression is decided by sample of first chunk of every file.
+    """
+    _compress = False
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = deque()
+        sock.sendall(MAGIC)
+
+    def feed_file(self, data, send_size):
+        """called with every chunk of file before it is sent"""
+        if data and send_size == len(data):
+            self._compress = compressible(data)
+
+    def sendall(self, data):
+        if not self._compress:
+            self.flush()
+            self._sock.sendall(FRAME.pack(RAW, len(data)))
+            self._sock.sendall(data)
+            return
+        # chunk may be a view of reused buffer
+        self._pending.append(self._executor.submit(pack_frame, bytes(data), True))
+        while len(self._pending) > MAX_PENDING or (self._pending and self._pending[0].done()):
+            self.send_frame(self._pending.popleft().result())
+
+    def send_frame(self, frame):
+        header, payload = frame
+        self._sock.sendall(header)
+        self._sock.sendall(payload)
+
+    def flush(self):
+        while self._pending:
+            self.send_frame(self._pending.popleft().result())
+
+    def close(self):
+        # shutdown(cancel_futures=True) needs python 3.9
+        while self._pending:
+            self._pending.popleft().cancel()
+        self._executor.shutdown()
+
+
+class CompressedPacket(object):
+    """unpack compressed stream, same interface as packet.
+
+    Frames are decompressed and parsed by "packet" in thread if "sock" is
+    given, so that file is written when receive next frames.
+    """
+    def __init__(self, packet, sock=None):
+        self._packet = packet
+        self._sock = sock
+        self._buff = RecvBuffer()
+        self._executor = None
+        self._pending = deque()
+        if sock:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def __getattr__(self, name):
+        return getattr(self._packet, name)
+
+    def unpack_frame(self, agent, codec, payload, from_addr):
+        if codec == ZLIB:
+            payload = zlib.decompress(payload)
+        elif codec != RAW:
+            raise ValueError('Unknown codec: %s' % codec)
+        self._buff.extend(payload)
+        return self._packet.unpack_tcp(agent, self._buff, from_addr)
+
+    def unpack_tcp(self, agent, data, from_addr):
+        ret = None
+        while len(data) >= FRAME.size:
+            codec, size = data.peek(FRAME)
+            if len(data) < FRAME.size + size:
+                break
+            data.consume(FRAME.size)
+            payload = bytes(data.read(size))
+            if self._executor:
+                self._pending.append(self._executor.submit(
+                    self.unpack_frame, agent, codec, payload, from_addr))
+            else:
+                ret = self.unpack_frame(agent, codec, payload, from_addr) or ret
+        while self._pending:
+            # wait for thread if too many frames or no more data
+            if len(self._pending) <= MAX_PENDING and not self._pending[0].done() and self.readable():
+                break
+            ret = self._pending.popleft().result() or ret
+        return ret
+
+    def wait(self):
+        """wait for all frames, return True if transfer complete"""
+        ret = None
+        while self._pending:
+            ret = self._pending.popleft().result() or ret
+        return ret
+
+    def readable(self):
+        if getattr(self._sock, 'pending', None) and self._sock.pending():
+            return True
+        return bool(select.select([self._sock], [], [], 0)[0])
+
+    def close(self):
+        if self._executor:
+            while self._pending:
+                self._pending.popleft().cancel()
+            self._executor.shutdown()
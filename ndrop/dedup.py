@@ -0,0 +1,224 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .digest import hash_file
+from .manifest import clone_file
+
+
+logger = logging.getLogger(__name__)
+
+
+# md5 of files in drop directory
+INDEX_NAME = '.ndrop-index'
+# small file is sent faster than it is hashed
+DEDUP_MIN_SIZE = 1024 * 1024
+HASH_WORKERS = 4
+# rebuilt file, moved in place when sender gets reply
+TEMP_PREFIX = '.ndrop-'
+TEMP_SUFFIX = '.dedup'
+
+
+def safe_path(directory, name):
+    """path of "name" in "directory", raise ValueError if it is out of it"""
+    path = os.path.normpath(os.path.join(directory, name.replace('/', os.sep)))
+    if not path.startswith(os.path.join(directory, '')):
+        raise ValueError('Invalid path: %s' % name)
+    return path
+
+
+def link_file(src, dst, hard=False):
+    """hard link or clone "src" to "dst" """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if hard:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    clone_file(src, dst)
+
+
+def hash_manifest(manifest, min_size=None, workers=None):
+    """return (files, links) for dedup request.
+
+    "files" is {name: [size, md5]} of files not less than "min_size".
+    "links" is {name: [source, hard]} of hard links and files with same
+    content, only source is sent.
+    """
+    min_size = min_size or DEDUP_MIN_SIZE
+    inodes = {}
+    links = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers or HASH_WORKERS) as executor:
+        for path, name, size in manifest:
+            if size < 0:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError as err:
+                logger.warning('Skip "%s": %s' % (path, err))
+                continue
+            source = inodes.setdefault((st.st_dev, st.st_ino), name)
+            if source != name:
+                links[name] = [source, True]
+            elif size >= min_size:
+                futures[name] = (size, executor.submit(hash_file, path, size))
+    files = {}
+    digests = {}
+    for name, (size, future) in futures.items():
+        md5 = future.result().hexdigest()
+        source = digests.setdefault(md5, name)
+        if source != name:
+            links[name] = [source, False]
+        else:
+            files[name] = [size, md5]
+    # source of hard link may be a copy of other file
+    for name, (source, hard) in links.items():
+        if source in links:
+            links[name] = [links[source][0], False]
+    return files, links
+
+
+class ContentIndex(object):
+    """md5 of files in drop directory, kept in INDEX_NAME.
+
+    Entry is {name: [size, mtime_ns, md5]}, it is hashed again in
+    background if file is changed.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+        self._path = os.path.join(directory, INDEX_NAME)
+        self._files = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._hashing = False   # new files are hashed in background
+        try:
+            with open(self._path) as f:
+                self._files = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            with open(self._path + '.tmp', 'w') as f:
+                json.dump(self._files, f)
+            os.replace(self._path + '.tmp', self._path)
+            self._dirty = False
+
+    def add(self, name, md5):
+        try:
+            st = os.stat(safe_path(self._directory, name))
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self._files[name] = [st.st_size, st.st_mtime_ns, md5]
+            self._dirty = True
+
+    def scan(self, sizes):
+        """files in directory with size in "sizes".
+
+        Return ({md5: name} of hashed files, [(name, path, size)] of new and
+        changed files).
+        """
+        digests = {}
+        stale = []
+        for dir_path, dirs, files in os.walk(self._directory):
+            for file_name in files:
+                # index, journal, part files and their temp files
+                if file_name.startswith('.ndrop-'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                name = os.path.relpath(path, self._directory).replace(os.sep, '/')
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if st.st_size not in sizes:
+                    continue
+                with self._lock:
+                    entry = self._files.get(name)
+                if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+                    stale.append((name, path, st.st_size))
+                else:
+                    digests.setdefault(entry[2], name)
+        return digests, stale
+
+    def hash_files(self, stale):
+        """hash new and changed files in thread, it doesn't keep process alive"""
+        try:
+            for name, path, size in stale:
+                try:
+                    self.add(name, hash_file(path, size).hexdigest())
+                except OSError as err:
+                    logger.warning('Index "%s": %s' % (name, err))
+            self.save()
+        finally:
+            with self._lock:
+                self._hashing = False
+
+    def find(self, files):
+        """files {name: [size, md5]} with content in directory, return {name: (source, md5)}.
+
+        Only hashed files are found, so request is never blocked by hash.
+        New and changed files are hashed in background for next request.
+        """
+        digests, stale = self.scan({size for size, md5 in files.values()})
+        with self._lock:
+            start = stale and not self._hashing
+            if start:
+                self._hashing = True
+        if start:
+            threading.Thread(target=self.hash_files, args=(stale,), daemon=True).start()
+        found = {}
+        for name, (size, md5) in files.items():
+            source = digests.get(md5)
+            if source is not None:
+                found[name] = (source, md5)
+        return found
+
+    def temp_path(self, name):
+        """file rebuilt for "name" before it is committed"""
+        dir_path, file_name = os.path.split(safe_path(self._directory, name))
+        return os.path.join(dir_path, TEMP_PREFIX + file_name + TEMP_SUFFIX)
+
+    def prepare(self, found):
+        """link sources of found files to temporary files, return {name: md5} of rebuilt"""
+        prepared = {}
+        for name, (source, md5) in found.items():
+            if source != name:
+                try:
+                    link_file(safe_path(self._directory, source), self.temp_path(name))
+                except (OSError, ValueError) as err:
+                    logger.warning('Dedup "%s": %s' % (name, err))
+                    continue
+            prepared[name] = md5
+        return prepared
+
+    def commit(self, prepared):
+        """move rebuilt files in place"""
+        for name, md5 in prepared.items():
+            path = self.temp_path(name)
+            if not os.path.lexists(path):   # file is in place already
+                continue
+            try:
+                os.replace(path, safe_path(self._directory, name))
+            except OSError as err:
+                logger.error('Dedup "%s": %s' % (name, err))
+                continue
+            self.add(name, md5)
+        self.save()
+
+    def drop(self, prepared):
+        """remove rebuilt files, sender doesn't know them"""
+        for name in prepared:
+            try:
+                os.remove(self.temp_path(name))
+            except OSError:
+                pass
@@ -0,0 +1,260 @@
+import os
+import queue
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# hash of file data, md5 is same as stock peers print
+ALGORITHMS = ['md5', 'blake2b', 'sha256', 'tree', 'none']
+HASH_WORKERS = os.cpu_count() or 4
+# chunks of one file waiting for worker, sender or receiver waits if it is full
+HASH_QUEUE = 16
+# checksum file of received files, same format as md5sum, b2sum, sha256sum
+SUM_FILES = {
+    'md5': 'MD5SUMS',
+    'blake2b': 'B2SUMS',
+    'sha256': 'SHA256SUMS',
+    'tree': 'B2TREESUMS',
+}
+# first line of checksum file, "--verify" knows hash if file is renamed
+SUM_HEADER = '# hash: %s'
+# tree hash, BLAKE2b of leaves is combined as binary Merkle tree
+TREE_LEAF_SIZE = 1024 * 1024
+TREE_DIGEST_SIZE = 32
+TREE_WORKERS = os.cpu_count() or 4
+# leaves of one file waiting for thread
+TREE_PENDING = TREE_WORKERS * 2
+# read size of file hashed on disk
+HASH_READ_SIZE = 1024 * 1024
+
+_tree_executor = None
+_tree_lock = threading.Lock()
+_hash_queues = None
+_hash_lock = threading.Lock()
+
+
+def new_hash(algorithm):
+    """hashlib object, None for "none" """
+    if algorithm == 'none':
+        return None
+    if algorithm == 'tree':
+        return TreeHash()
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, size, algorithm='md5'):
+    """hash of first "size" bytes of file, None if algorithm is "none" """
+    hash_obj = new_hash(algorithm)
+    if hash_obj is None:
+        return None
+    with open(path, 'rb') as f:
+        while size > 0:
+            data = f.read(min(HASH_READ_SIZE, size))
+            if not data:
+                break
+            hash_obj.update(data)
+            size -= len(data)
+    return hash_obj
+
+
+def digest_line(digest, path):
+    """line of md5sum output, only path if no digest"""
+    if digest is None:
+        return path
+    return '%s  %s' % (digest, path)
+
+
+def sum_line(digest, name):
+    """line of checksum file, name with "\\" or newline is escaped as md5sum"""
+    if '\\' in name or '\n' in name:
+        return '\\%s  %s' % (digest, name.replace('\\', '\\\\').replace('\n', '\\n'))
+    return '%s  %s' % (digest, name)
+
+
+def tree_executor():
+    """thread pool of leaves, shared by all files"""
+    global _tree_executor
+    with _tree_lock:
+        if _tree_executor is None:
+            _tree_executor = ThreadPoolExecutor(max_workers=TREE_WORKERS)
+        return _tree_executor
+
+
+def hash_queues():
+    """queues of hash worker threads, shared by all HashPool.
+
+    Worker only updates hash object it gets, so threads are started once
+    and not for every client or server.
+    """
+    global _hash_queues
+    with _hash_lock:
+        if _hash_queues is None:
+            _hash_queues = []
+            for _ in range(HASH_WORKERS):
+                q = queue.Queue()
+                threading.Thread(target=hash_worker, args=(q,), daemon=True).start()
+                _hash_queues.append(q)
+        return _hash_queues
+
+
+def hash_worker(q):
+    while True:
+        hash_obj, data, pending = q.get()
+        if hash_obj is None:
+            data.set()
+        else:
+            hash_obj.update(data)
+            pending.release()
+
+
+def hash_leaf(data):
+    return hashlib.blake2b(data, digest_size=TREE_DIGEST_SIZE, person=b'ndrop-leaf').digest()
+
+
+def hash_node(left, right):
+    return hashlib.blake2b(left + right, digest_size=TREE_DIGEST_SIZE, person=b'ndrop-node').digest()
+
+
+def merkle_root(leaves):
+    """pair nodes level by level, last odd node is moved up"""
+    level = list(leaves)
+    while len(level) > 1:
+        parents = [hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def damaged_ranges(leaves, other, leaf_size=TREE_LEAF_SIZE):
+    """byte ranges [(start, end)] where leaf digests are different"""
+    ranges = []
+    for index in range(max(len(leaves), len(other))):
+        if index < len(leaves) and index < len(other) and leaves[index] == other[index]:
+            continue
+        start = index * leaf_size
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + leaf_size)
+        else:
+            ranges.append((start, start + leaf_size))
+    return ranges
+
+
+class TreeHash(object):
+    """tree hash of file, same interface as hashlib object.
+
+    Data is cut into leaves of TREE_LEAF_SIZE, full leaves are hashed in
+    thread pool when data arrives, so one file is hashed by all cores.
+    Digest of every leaf shows which range of file is damaged.
+    """
+    name = 'tree'
+    leaf_size = TREE_LEAF_SIZE
+
+    def __init__(self, data=None):
+        self._executor = tree_executor()
+        self._leaves = []   # digest or future of leaf
+        self._done = 0
+        self._buff = bytearray()
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            count = min(self.leaf_size - len(self._buff), len(data))
+            self._buff += data[:count]
+            data = data[count:]
+            if len(self._buff) == self.leaf_size:
+                self._leaves.append(self._executor.submit(hash_leaf, self._buff))
+                self._buff = bytearray()
+                self.wait(TREE_PENDING)
+
+    def wait(self, pending):
+        """wait for leaves until at most "pending" are in thread"""
+        while len(self._leaves) - self._done > pending:
+            self._leaves[self._done] = self._leaves[self._done].result()
+            self._done += 1
+
+    def leaves(self):
+        """digests of leaves, last leaf may be short"""
+        self.wait(0)
+        if self._buff or not self._leaves:
+            return self._leaves + [hash_leaf(self._buff)]
+        return list(self._leaves)
+
+    def digest(self):
+        return merkle_root(self.leaves())
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+class StreamHash(object):
+    """hash of one file, updated by worker thread of HashPool.
+
+    Data is copied to queue if it isn't bytes, as it may be a view of
+    buffer which is reused when chunk is sent or received. At most
+    HASH_QUEUE chunks of file are queued, so one fast session doesn't
+    fill the memory or delay files of other sessions on same worker.
+    """
+    def __init__(self, queue, hash_obj):
+        self._queue = queue
+        self._hash = hash_obj
+        self._pending = threading.BoundedSemaphore(HASH_QUEUE)
+
+    def update(self, data):
+        if self._hash is None or not data:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self._pending.acquire()
+        self._queue.put((self._hash, data, self._pending))
+
+    def hexdigest(self):
+        """wait for queued data, None if no hash"""
+        if self._hash is None:
+            return None
+        done = threading.Event()
+        self._queue.put((None, done, None))
+        done.wait()
+        return self._hash.hexdigest()
+
+
+class HashPool(object):
+    """hash file data in threads, not in thread of socket.
+
+    Every file is hashed by one worker in order, files are spread over
+    workers. hashlib releases GIL for large data. Workers are shared by
+    all pools, see hash_queues().
+    """
+    algorithm = 'md5'
+
+    def __init__(self, algorithm=None):
+        self.algorithm = algorithm or self.algorithm
+        if self.algorithm not in ALGORITHMS:
+            raise ValueError('Unknown hash: %s' % self.algorithm)
+        if self.algorithm in ('none', 'tree'):
+            return
+        self._next = itertools.cycle(hash_queues())
+        self._lock = threading.Lock()
+
+    def new(self, hash_obj=None):
+        """StreamHash of file, continue "hash_obj" if it is given"""
+        if self.algorithm == 'none':
+            return StreamHash(None, None)
+        if self.algorithm == 'tree':
+            # leaves are hashed in thread already
+            return hash_obj or TreeHash()
+        with self._lock:
+            q = next(self._next)
+        return StreamHash(q, hash_obj or new_hash(self.algorithm))
+
+    def hexdigest(self, data):
+        """digest of small data in current thread"""
+        hash_obj = new_hash(self.algorithm)
+        if hash_obj is None:
+            return None
+        hash_obj.update(data)
+        return hash_obj.hexdigest()
@@ -1,16 +1,21 @@
-import sys
 import time
 import logging
 import os.path
 import threading
 import socket
 import socketserver
+import struct
 import ssl
 import getpass
+from concurrent.futures import ThreadPoolExecutor
 
-from .transport import Transport, \
-    get_broadcast_address, CHUNK_SIZE, set_chunk_size, \
+from .transport import Transport, ThreadPoolTCPServer, BUFFER_POOL, DIRECT_WINDOW, SEND_BUFFER_SIZE, \
+    ReadAhead, FileChangedError, recv_into_file, prefetch_files, advise_file, \
+    fit_chunks, zero_chunks, \
+    FEATURES, FEATURE_QUERY, get_broadcast_address, \
     get_platform_name, get_platform_system
+from .compress import FEATURE as COMPRESS_FEATURE, CompressWriter, CompressedPacket
+from .extension import unwrap_packet
 from .about import get_system_symbol
 
 
@@ -28,6 +33,14 @@ STATUS = {
     'data': 3,
 }
 
+# record count, total size
+TRANSFER_HEADER = struct.Struct('<qq')
+FILE_SIZE = struct.Struct('<q')
+# write file data directly if left size is more than it
+DIRECT_MIN_SIZE = 1024 * 1024
+# send file with sendfile if file size is more than it
+SENDFILE_MIN_SIZE = 1024 * 64
+
 
 class DuktoPacket():
     _name = 'Dukto'
@@ -85,6 +98,16 @@ class DuktoPacket():
                     agent.say_hello((client_address[0], agent._udp_port))
                 agent.add_node(client_address[0], tcp_port, data.decode('utf-8'))
 
+    def unpack_features(self, data):
+        """ndrop extensions in hello, "user at host (os) [ndrop zlib]" """
+        msg_type = data.pop(0)
+        if msg_type in [0x04, 0x05]:
+            del data[:2]
+        _, sep, features = data.decode('utf-8').partition(' [ndrop ')
+        if not sep:
+            return []
+        return features.rstrip(']').split(',')
+
     def pack_text(self, text):
         data = bytearray()
         text_data = text.encode('utf-8')
@@ -107,88 +130,89 @@ class DuktoPacket():
         data.extend(total_size.to_bytes(8, byteorder='little', signed=True))
         return data
 
-    def pack_files(self, agent, total_size, files):
+    def pack_file_header(self, name, size):
+        # packet format
+        # B * n B    D    B * size
+        # name  0x00 size data
         data = bytearray()
-        total_send_size = 0
-        transfer_abort = False
-        for path, name, size in files:
-            # packet format
-            # B * n B    D    B * size
-            # name  0x00 size data
-            data.extend(name.encode('utf-8'))
-            data.append(0x00)
-            data.extend(size.to_bytes(8, byteorder='little', signed=True))
-            send_size = 0
-            if size < 0:  # directory
-                agent.send_feed_file(
-                    name, None,
-                    send_size, -1, total_send_size, total_size)
-            elif size == 0:  # file, size equal 0
-                agent.send_feed_file(
-                    name, b'',
-                    send_size, 0, total_send_size, total_size)
-            else:
-                file_changed = False
-                with open(path, 'rb') as f:
-                    while not file_changed:
-                        if len(data) >= CHUNK_SIZE:
-                            yield data[:CHUNK_SIZE]
-                            del data[:CHUNK_SIZE]
-                        chunk = f.read(CHUNK_SIZE - len(data))
-                        # next file
-                        if not chunk:
-                            break
+        data.extend(name.encode('utf-8'))
+        data.append(0x00)
+        data.extend(size.to_bytes(8, byteorder='little', signed=True))
+        return data
 
-                        if (send_size + len(chunk)) > size:
-                            file_changed = True
-                            # correct size
-                            chunk = chunk[:size - send_size]
-                            logger.error('File Changed: [%s] %s => %s.' % (name, size, send_size))
-                            cont = input('Drop data and continue? [Yes/No]')
-                            if cont.lower() != 'yes':
-                                transfer_abort = True
+    def pack_files(self, agent, total_size, files, offsets=None):
+        """"offsets" is {name: offset} of resumed files, they are sent from offset"""
+        data = bytearray()
+        total_send_size = 0
+        offsets = offsets or {}
+        # read file data in thread when send
+        reader = ReadAhead(files, offsets=offsets)
+        try:
+            for path, name, size in files:
+                offset = offsets.get(name, 0)
+                size -= offset
+                data.extend(self.pack_file_header(name, size))
+                # read size may be tuned when send
+                if len(data) >= agent._read_size:
+                    yield data
+                    data = bytearray()
+                send_size = 0
+                if size < 0:  # directory
+                    agent.send_feed_file(
+                        name, None,
+                        send_size, -1, total_send_size, total_size)
+                elif size == 0:  # file, size equal 0
+                    agent.send_feed_file(
+                        name, b'',
+                        send_size, 0, total_send_size, total_size)
+                else:
+                    chunks = reader.chunks(path, size, offset)
+                    for chunk in fit_chunks(agent.file_changed, path, name, size, chunks, offset):
                         send_size += len(chunk)
                         total_send_size += len(chunk)
                         agent.send_feed_file(
                             name, chunk,
                             send_size, size, total_send_size, total_size,
                         )
-                        data.extend(chunk)
-            agent.send_finish_file(name)
-            if transfer_abort:
-                break
-        if len(data) > 0:
-            yield data
-            data.clear()
-        if transfer_abort:
-            sys.exit('Transfer Abort!!!')
+                        if len(data) + len(chunk) < agent._read_size:
+                            data.extend(chunk)
+                        else:
+                            # send large chunk without copy
+                            if data:
+                                yield data
+                                data = bytearray()
+                            yield chunk
+                agent.send_finish_file(name)
+            if len(data) > 0:
+                yield data
+        finally:
+            reader.close()
 
     def unpack_tcp(self, agent, data, from_addr):
+        """parse RecvBuffer "data" by its read cursor.
+
+        File data is passed to agent as memoryview of receive buffer,
+        it is only valid in "recv_feed_file".
+        """
         while len(data) > 0:
             if self._status == STATUS['idle']:
-                value = data[:8]
-                del data[:8]
-                self._record = int.from_bytes(value, byteorder='little', signed=True)
+                if len(data) < TRANSFER_HEADER.size:
+                    return
+                self._record, self._total_size = data.unpack(TRANSFER_HEADER)
                 self._recv_record = 0
-                value = data[:8]
-                del data[:8]
-                self._total_size = int.from_bytes(value, byteorder='little', signed=True)
                 self._total_recv_size = 0
                 self._status = STATUS['filename']
             elif self._status == STATUS['filename']:
-                pos = data.find(b'\0', 0)
+                pos = data.find(b'\0')
                 if pos < 0:
                     return
-                value = data[:pos]
-                del data[:pos + 1]
-                self._filename = value.decode('utf-8')
+                self._filename = str(data.read(pos), 'utf-8')
+                data.consume(1)
                 self._status = STATUS['filesize']
             elif self._status == STATUS['filesize']:
-                if len(data) < 8:
+                if len(data) < FILE_SIZE.size:
                     return
-                value = data[:8]
-                del data[:8]
-                self._filesize = int.from_bytes(value, byteorder='little', signed=True)
+                self._filesize, = data.unpack(FILE_SIZE)
                 self._recv_file_size = 0
 
                 if self._filesize > 0:
@@ -210,48 +234,63 @@ class DuktoPacket():
                             self._total_recv_size == self._total_size:
                         self._status = STATUS['idle']
                         data.clear()
+                        return True
                     else:
                         self._status = STATUS['filename']
             elif self._status == STATUS['data']:
-                size = min(self._filesize - self._recv_file_size, len(data))
-                self._recv_file_size += size
-                self._total_recv_size += size
-
-                agent.recv_feed_file(
-                    self._filename, data[:size],
-                    self._recv_file_size, self._filesize,
-                    self._total_recv_size, self._total_size,
-                    from_addr,
-                )
-                del data[:size]
-
-                if self._recv_file_size == self._filesize:
-                    self._status = STATUS['filename']
-                    self._recv_record += 1
-                    agent.recv_finish_file(self._filename, from_addr)
-                if self._recv_record == self._record and  \
-                        self._total_recv_size == self._total_size:
-                    # transfer complete
-                    self._status = STATUS['idle']
+                chunk = data.read(self._filesize - self._recv_file_size)
+                ret = self.unpack_data(agent, chunk, from_addr)
+                chunk.release()
+                if ret:
                     data.clear()
                     return True
 
+    def in_file(self):
+        """True if data of current file is not received completely"""
+        return self._status == STATUS['data']
+
+    def unpack_data(self, agent, chunk, from_addr):
+        """data of current file, return True if transfer complete"""
+        self._recv_file_size += len(chunk)
+        self._total_recv_size += len(chunk)
+
+        agent.recv_feed_file(
+            self._filename, chunk,
+            self._recv_file_size, self._filesize,
+            self._total_recv_size, self._total_size,
+            from_addr,
+        )
+
+        if self._recv_file_size == self._filesize:
+            self._status = STATUS['filename']
+            self._recv_record += 1
+            agent.recv_finish_file(self._filename, from_addr)
+        if self._recv_record == self._record and  \
+                self._total_recv_size == self._total_size:
+            # transfer complete
+            self._status = STATUS['idle']
+            return True
+
 
 class UDPHandler(socketserver.BaseRequestHandler):
     def setup(self):
         self._packet = DuktoPacket()
 
     def handle(self):
-        if self.client_address[0] not in self.server.agent._ip_addrs:
+        if self.request[0] == FEATURE_QUERY:
+            self.server.agent.say_features(self.client_address)
+        elif self.client_address[0] not in self.server.agent._ip_addrs:
             data = bytearray(self.request[0])
             self._packet.unpack_udp(self.server.agent, data, self.client_address)
 
 
 class TCPHandler(socketserver.BaseRequestHandler):
     def setup(self):
-        self._recv_buff = bytearray()
+        self._recv_buff = BUFFER_POOL.get()
         self._packet = DuktoPacket()
         self.request.settimeout(20)
+        self._tuner = self.server.agent.create_tuner(self.server.agent._recv_size)
+        self._err = 'abort'   # handle() may be broken by exception
 
     def handle(self):
         """
@@ -261,13 +300,44 @@ class TCPHandler(socketserver.BaseRequestHandler):
         logger.info('[Dukto] connect from %s:%s' % self.client_address)
         err = ''
         ret = None
+        # file data follows header, write it directly if no TLS
+        direct = not isinstance(self.request, ssl.SSLSocket)
+        # stream of ndrop sender may be compressed or control request
+        unwrapped = False
         while True:
             try:
-                data = self.request.recv(CHUNK_SIZE)
-                if not data:
-                    err = 'abort'
+                if direct and self._packet._status == STATUS['data'] and \
+                        self._packet._filesize - self._packet._recv_file_size >= DIRECT_MIN_SIZE:
+                    fileno = self.server.agent.recv_file_fileno(
+                        self._packet._filename,
+                        self._packet._filesize, self._packet._total_size,
+                        self.client_address)
+                    if fileno is not None:
+                        ret = self.recv_direct(fileno)
+                        if ret is None:
+                            err = 'abort'
+                            break
+                        if ret:
+                            err = 'done'
+                            break
+                        continue
+                num = self._recv_buff.recv_into(self.request, self._tuner.size)
+                if not num:
+                    # sender close connection after last frame
+                    if isinstance(self._packet, CompressedPacket) and self._packet.wait():
+                        err = 'done'
+                    else:
+                        err = 'abort'
                     break
-                self._recv_buff.extend(data)
+                self._tuner.update(num)
+                if not unwrapped:
+                    packet = unwrap_packet(self._packet, self._recv_buff, self.request)
+                    if packet is None:
+                        continue
+                    unwrapped = True
+                    if isinstance(packet, CompressedPacket):
+                        direct = False
+                    self._packet = packet
                 ret = self._packet.unpack_tcp(self.server.agent, self._recv_buff, self.client_address)
             except Exception as e:
                 err = e
@@ -276,18 +346,42 @@ class TCPHandler(socketserver.BaseRequestHandler):
             if ret:
                 err = 'done'
                 break
-        if err == 'abort':
-            self.server.agent.recv_finish_file(self._packet._filename, self.client_address)
-        self.server.agent.recv_finish(self.client_address, err)
+        self._err = err
+
+    def recv_direct(self, fileno):
+        """receive left data of current file into "fileno".
+
+        Return True if transfer complete, False if file complete, None if
+        connection is closed.
+        """
+        offset = self._packet._recv_file_size
+        size = self._packet._filesize - offset
+        for chunk in recv_into_file(self.request, fileno, offset, size):
+            if self._packet.unpack_data(self.server.agent, chunk, self.client_address):
+                return True
+        if self._packet._status == STATUS['data']:
+            return None
+        return False
 
     def finish(self):
-        pass
+        """called on every exit of handle()"""
+        try:
+            if isinstance(self._packet, CompressedPacket):
+                # wait for file data in thread
+                self._packet.close()
+            if self._err != 'done' and self._packet.in_file():
+                # reset, timeout or error, truncate and journal part file
+                self.server.agent.recv_finish_file(self._packet._filename, self.client_address)
+        finally:
+            self.server.agent.recv_finish(self.client_address, self._err)
+            BUFFER_POOL.put(self._recv_buff)
 
 
 class DuktoServer(Transport):
     _name = 'Dukto'
     _cert = None
     _key = None
+    _ssl_context = None
     _upper_level = None
     _tcp_server = None
     _udp_server = None
@@ -302,11 +396,12 @@ class DuktoServer(Transport):
     _node = None
     _nodes = None
     _loop_hello = True
+    _hello_interval = 30
 
     def __repr__(self):
         return '<DuktoServer>'
 
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    def __init__(self, upper_level, addr, ssl_ck=None, max_workers=None, io_size=None):
         if ssl_ck:
             self._cert, self._key = ssl_ck
         addr = addr.split(':')
@@ -326,14 +421,25 @@ class DuktoServer(Transport):
         self._udp_server = socketserver.UDPServer((ip, self._udp_port), UDPHandler)
         self._udp_server.agent = self
 
-        self._tcp_server = socketserver.TCPServer((ip, self._tcp_port), TCPHandler)
         if self._cert and self._key:
             self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
             self._ssl_context.load_cert_chain(self._cert, keyfile=self._key)
-            self._tcp_server.socket = self._ssl_context.wrap_socket(
-                self._tcp_server.socket, server_side=True)
+            # sender never read, unread session ticket will reset connection when close
+            self._ssl_context.num_tickets = 0
+        # every connection is handled in worker pool, with TLS if need
+        self._tcp_server = ThreadPoolTCPServer(
+            (ip, self._tcp_port), TCPHandler,
+            max_workers=max_workers, ssl_context=self._ssl_context, bind_and_activate=False)
         self._tcp_server.agent = self
-        set_chunk_size()
+        self.set_io_size(**(io_size or {}))
+        # buffer size is used for TCP window scale only if it is set before listen
+        self.setup_socket(self._tcp_server.socket)
+        try:
+            self._tcp_server.server_bind()
+            self._tcp_server.server_activate()
+        except OSError:
+            self._tcp_server.server_close()
+            raise
 
         self._unicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -351,7 +457,9 @@ class DuktoServer(Transport):
             target=self.loop_say_hello,
             daemon=True,
         ).start()
+        self.show_listen()
 
+    def show_listen(self):
         logger.info('My Node: %s' % self.format_node())
         if self._tcp_server.server_address[0] == '0.0.0.0':
             logger.info('[Dukto] listen on %s:%s(tcp):%s(udp) - bind on %s' % (
@@ -390,12 +498,23 @@ class DuktoServer(Transport):
                 recv_size, file_size,
                 total_recv_size, total_size, from_addr)
 
+    def recv_file_fileno(self, path, file_size, total_size, from_addr):
+        if path == TEXT_TAG:
+            return None
+        return self._upper_level.recv_file_fileno(path, file_size, total_size, from_addr)
+
     def recv_finish_file(self, path, from_addr):
         if path == TEXT_TAG:
             self._upper_level.recv_finish_text(from_addr)
         else:
             self._upper_level.recv_finish_file(path, from_addr)
 
+    def recv_control(self, message, from_addr):
+        return self._upper_level.recv_control(message, from_addr)
+
+    def recv_control_replied(self, from_addr):
+        self._upper_level.recv_control_replied(from_addr)
+
     def recv_finish(self, from_addr, err):
         """当前任务全部完成，被TCPHandler调用"""
         self._upper_level.recv_finish(from_addr, err)
@@ -422,10 +541,22 @@ class DuktoServer(Transport):
             except Exception as err:
                 logger.error('[Dukto] send to "%s" error: %s' % (dest, err))
 
+    def say_features(self, dest):
+        """unicast hello with ndrop extensions at end of signature"""
+        signature = '%s [ndrop %s]' % (self.get_signature(), ','.join(FEATURES))
+        data = self._packet.pack_hello(signature, self._tcp_port, dest)
+        try:
+            self._unicast_sock.sendto(data, dest)
+        except Exception as err:
+            logger.error('[Dukto] send to "%s" error: %s' % (dest, err))
+
+    def hello(self):
+        self.say_hello(('<broadcast>', self._udp_port))
+
     def loop_say_hello(self):
         while self._loop_hello:
-            self.say_hello(('<broadcast>', self._udp_port))
-            time.sleep(30)
+            self.hello()
+            time.sleep(self._hello_interval)
 
     def say_goodbye(self):
         data = self._packet.pack_goodbye()
@@ -480,9 +611,11 @@ class DuktoClient(Transport):
     _upper_level = None
     _packet = None
     _address = None
+    _sock = None
+    _writer = None
     _timeout = 5
 
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    def __init__(self, upper_level, addr, ssl_ck=None, io_size=None):
         if ssl_ck:
             self._cert, self._key = ssl_ck
         self._upper_level = upper_level
@@ -492,9 +625,14 @@ class DuktoClient(Transport):
             tcp_port = int(addr.pop(0))
         else:
             tcp_port = DEFAULT_TCP_PORT
+        if len(addr) > 0:
+            udp_port = int(addr.pop(0))
+        else:
+            udp_port = DEFAULT_UDP_PORT
         self._address = (ip, tcp_port)
+        self._udp_address = (ip, udp_port)
         self._packet = DuktoPacket()
-        set_chunk_size()
+        self.set_io_size(**(io_size or {}))
 
     def send_text(self, text):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -522,22 +660,32 @@ class DuktoClient(Transport):
 
     def send_files(self, total_size, files):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setup_socket(sock)
         if self._cert and self._key:
             ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
             sock = ssl_context.wrap_socket(sock, server_side=False)
         header = self._packet.pack_files_header(len(files), total_size)
+        compress = self._compress and COMPRESS_FEATURE in self.query_features(self._udp_address)
         sock.settimeout(self._timeout)
         err = 'done'
         try:
             sock.connect(self._address)
-            sock.sendall(header)
-            for chunk in self._packet.pack_files(self, total_size, files):
-                sock.sendall(chunk)
+            if compress:
+                self.send_compressed(sock, header, total_size, files)
+            elif isinstance(sock, ssl.SSLSocket) or self._offsets:
+                sock.sendall(header)
+                tuner = self.create_tuner(self._read_size)
+                for chunk in self._packet.pack_files(self, total_size, files, self._offsets):
+                    sock.sendall(chunk)
+                    self._read_size = tuner.update(len(chunk))
+            else:
+                sock.sendall(header)
+                self.sendfile_files(sock, total_size, files)
         except KeyboardInterrupt:
             pass
-        except socket.timeout as e:
+        except (socket.timeout, FileChangedError) as e:
             err = f'Failed to send Files: {e}'
             logger.error(err)
         except Exception as e:
@@ -547,9 +695,146 @@ class DuktoClient(Transport):
         sock.close()
         self.send_finish(err)
 
+    def send_compressed(self, sock, header, total_size, files):
+        """send stream in compressed frames, peer is ndrop"""
+        self._writer = CompressWriter(sock)
+        try:
+            self._writer.sendall(header)
+            for chunk in self._packet.pack_files(self, total_size, files, self._offsets):
+                self._writer.sendall(chunk)
+            self._writer.flush()
+        finally:
+            self._writer.close()
+            self._writer = None
+
+    def send_stream(self, total_size, count, items):
+        """send file data prepared by caller.
+
+        "items" yield (name, size, chunk), chunk is None at start of file.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setup_socket(sock)
+        if self._cert and self._key:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            sock = ssl_context.wrap_socket(sock, server_side=False)
+        sock.settimeout(self._timeout)
+        self._sock = sock
+        try:
+            sock.connect(self._address)
+            data = self._packet.pack_files_header(count, total_size)
+            for name, size, chunk in items:
+                if chunk is None:
+                    data.extend(self._packet.pack_file_header(name, size))
+                    continue
+                if data:
+                    sock.sendall(data)
+                    data.clear()
+                sock.sendall(chunk)
+            if data:
+                sock.sendall(data)
+        finally:
+            sock.close()
+            self._sock = None
+
+    def abort(self):
+        """stop "send_stream" from other thread"""
+        sock = self._sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def sendfile_files(self, sock, total_size, files):
+        """send file data with sendfile, the kernel copy it to socket.
+
+        File data is read again and fed to upper level in "hasher" thread,
+        so md5 and progress run in parallel with sending.
+        """
+        data = bytearray()
+        batch = []
+        total_send_size = 0
+        with ThreadPoolExecutor(max_workers=1) as hasher:
+            for path, name, size, chunk in prefetch_files(files, SENDFILE_MIN_SIZE):
+                data.extend(self._packet.pack_file_header(name, size))
+                if size < 0:  # directory
+                    batch.append((name, None, -1))
+                elif size < SENDFILE_MIN_SIZE:  # small file, send with header
+                    chunk = chunk or b''
+                    if len(chunk) != size:
+                        chunk = b''.join(fit_chunks(self.file_changed, path, name, size, [chunk]))
+                    total_send_size += size
+                    batch.append((name, chunk, size))
+                    data.extend(chunk)
+                else:
+                    sock.sendall(data)
+                    data.clear()
+                    if batch:
+                        hasher.submit(self.send_feed_files, batch, total_send_size, total_size)
+                        batch = []
+                    with open(path, 'rb') as f, open(path, 'rb') as hash_file:
+                        advise_file(f.fileno(), 0, 0, 'SEQUENTIAL')
+                        end = size
+                        file_size = os.fstat(f.fileno()).st_size
+                        if file_size != size:
+                            if self.file_changed(name, size, file_size) == 'skip':
+                                end = 0
+                            else:
+                                end = min(size, file_size)
+                        try:
+                            send_size = 0
+                            while send_size < end:
+                                count = min(DIRECT_WINDOW, end - send_size)
+                                # read next window when send this one
+                                advise_file(f.fileno(), send_size + count, DIRECT_WINDOW, 'WILLNEED')
+                                sent = sock.sendfile(f, send_size, count)
+                                if sent == 0:   # file is truncated
+                                    self.file_changed(name, size, send_size)
+                                    break
+                                send_size += sent
+                                total_send_size += sent
+                                hasher.submit(
+                                    self.feed_file, name, hash_file, sent,
+                                    send_size, size, total_send_size, total_size)
+                            for chunk in zero_chunks(size - send_size):
+                                sock.sendall(chunk)
+                                send_size += len(chunk)
+                                total_send_size += len(chunk)
+                                hasher.submit(
+                                    self.send_feed_file, name, chunk,
+                                    send_size, size, total_send_size, total_size)
+                        finally:
+                            # file can't be closed before hasher read it
+                            hasher.submit(int).result()
+                    hasher.submit(self.send_finish_file, name)
+                if len(data) >= SEND_BUFFER_SIZE:
+                    sock.sendall(data)
+                    data.clear()
+                    if batch:
+                        hasher.submit(self.send_feed_files, batch, total_send_size, total_size)
+                        batch = []
+            if len(data) > 0:
+                sock.sendall(data)
+            if batch:
+                hasher.submit(self.send_feed_files, batch, total_send_size, total_size)
+
+    def feed_file(self, path, f, size, send_size, file_size, total_send_size, total_size):
+        """read data sent by sendfile for upper level"""
+        data = f.read(size)
+        if len(data) < size:    # file is truncated
+            data += bytes(size - len(data))
+        self.send_feed_file(path, data, send_size, file_size, total_send_size, total_size)
+
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        if self._writer:
+            self._writer.feed_file(data, send_size)
         self._upper_level.send_feed_file(path, data, send_size, file_size, total_send_size, total_size)
 
+    def send_feed_files(self, files, total_send_size, total_size):
+        self._upper_level.send_feed_files(files, total_send_size, total_size)
+
     def send_finish_file(self, path):
         """当前文件发送完成"""
         self._upper_level.send_finish_file(path)
@@ -0,0 +1,50 @@
+import logging
+
+from .transport import CONTROL_MAGIC, pack_message, unpack_message
+from .compress import MAGIC as COMPRESS_MAGIC, CompressedPacket
+
+
+logger = logging.getLogger(__name__)
+
+
+class ControlPacket(object):
+    """request of control connection, same interface as packet"""
+    _filename = None
+
+    def __init__(self, send):
+        self._send = send
+
+    def pack_success(self):
+        """reply is sent already"""
+        return b''
+
+    def in_file(self):
+        """no file in control connection"""
+        return False
+
+    def unpack_tcp(self, agent, data, from_addr):
+        message = unpack_message(data)
+        if message is None:
+            return None
+        self._send(pack_message(agent.recv_control(message, from_addr)))
+        # receiver acts on request only if sender gets reply
+        agent.recv_control_replied(from_addr)
+        return True
+
+
+def unwrap_packet(packet, data, sock=None, send=None):
+    """packet to unpack stream "data" by its first bytes.
+
+    Return CompressedPacket or ControlPacket for ndrop sender, "packet"
+    for others, None if "data" is too short to know.
+    """
+    for magic in [COMPRESS_MAGIC, CONTROL_MAGIC]:
+        if len(data) < len(magic):
+            if data.find(magic[:len(data)]) == 0:
+                return None
+        elif data.find(magic) == 0:
+            data.consume(len(magic))
+            if magic == CONTROL_MAGIC:
+                return ControlPacket(send or sock.sendall)
+            return CompressedPacket(packet, sock)
+    return packet
@@ -0,0 +1,121 @@
+import queue
+import logging
+import threading
+
+from .transport import fit_chunks, read_chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+# chunks a peer may fall behind the fastest peer before it is dropped
+FANOUT_QUEUE = 256
+
+
+class Peer(object):
+    """one destination, send chunks from its bounded queue in thread"""
+    name = None
+    err = None
+
+    def __init__(self, name, transport, total_size, count):
+        self.name = name
+        self._transport = transport
+        self._queue = queue.Queue(FANOUT_QUEUE)
+        self._thread = threading.Thread(
+            target=self.run, args=(total_size, count), daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def alive(self):
+        return self.err is None and self._thread.is_alive()
+
+    def items(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            yield item
+
+    def run(self, total_size, count):
+        try:
+            self._transport.send_stream(total_size, count, self.items())
+        except Exception as err:
+            if self.err is None:
+                self.err = err
+                logger.error('%s: %s' % (self.name, err))
+        else:
+            if self.err is None:
+                self.err = 'done'
+
+    def put(self, item, block=True):
+        """return False if peer is dead or queue is full"""
+        while self.alive():
+            try:
+                self._queue.put(item, block=block, timeout=1)
+                return True
+            except queue.Full:
+                if not block:
+                    return False
+        return False
+
+    def drop(self, err):
+        if self.err is None:
+            self.err = err
+            logger.error('%s: %s' % (self.name, err))
+        self._transport.abort()
+        # wake up if thread wait for item
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+def put_all(peers, item):
+    """put item to the fastest peer and wait, drop others if they fall behind"""
+    while True:
+        alive = [peer for peer in peers if peer.alive()]
+        if not alive:
+            raise ConnectionError('No destination is alive')
+        leader = min(alive, key=lambda peer: peer._queue.qsize())
+        if leader.put(item):
+            break
+    for peer in alive:
+        if peer is not leader and not peer.put(item, block=False):
+            peer.drop('Drop: too slow, fall behind %s chunks' % FANOUT_QUEUE)
+
+
+def send_fanout(agent, peers, manifest, read_size):
+    """read every file once and send to all peers"""
+    total_size = manifest.total_size
+    total_send_size = 0
+    for peer in peers:
+        peer.start()
+    try:
+        for path, name, size in manifest:
+            put_all(peers, (name, size, None))
+            send_size = 0
+            if size < 0:    # directory
+                agent.send_feed_file(name, None, send_size, -1, total_send_size, total_size)
+            elif size == 0:
+                agent.send_feed_file(name, b'', send_size, 0, total_send_size, total_size)
+            else:
+                chunks = read_chunks(path, size, read_size)
+                for chunk in fit_chunks(agent.file_changed, path, name, size, chunks):
+                    put_all(peers, (name, size, chunk))
+                    send_size += len(chunk)
+                    total_send_size += len(chunk)
+                    agent.send_feed_file(name, chunk, send_size, size, total_send_size, total_size)
+            agent.send_finish_file(name)
+    except BaseException as err:
+        for peer in peers:
+            peer.drop(err)
+        raise
+    finally:
+        for peer in peers:
+            peer.put(None)
+        for peer in peers:
+            peer.join()
@@ -0,0 +1,307 @@
+import os
+import stat
+import logging
+import heapq
+import shutil
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+SCAN_WORKERS = 8
+READ_SIZE = 1024 * 64
+# max size of stdin spooled to disk
+SPOOL_SIZE = 1024 * 1024 * 1024 * 4
+SPOOL_READ_SIZE = 1024 * 1024
+# ioctl of linux, clone file by reflink
+FICLONE = 0x40049409
+
+
+class Manifest(object):
+    """compact list of files to send.
+
+    Directories are interned, file names are kept in one byte blob with
+    offset array, size is kept in array. Iterate it to get
+    (abs_path, rel_path, size), rel_path is built when it is needed.
+    """
+    total_size = 0
+
+    def __init__(self):
+        self._dirs = []
+        self._dir_index = {}
+        self._names = bytearray()
+        self._name_ends = array('Q')
+        self._parents = array('L')
+        self._rel_starts = array('L')
+        self._sizes = array('q')
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def append(self, abs_path, rel_start, size):
+        """rel_path is abs_path[rel_start:], size is -1 for directory"""
+        dir_path, name = os.path.split(abs_path)
+        index = self._dir_index.get(dir_path)
+        if index is None:
+            index = self._dir_index[dir_path] = len(self._dirs)
+            self._dirs.append(dir_path)
+        self._names.extend(os.fsencode(name))
+        self._name_ends.append(len(self._names))
+        self._parents.append(index)
+        self._rel_starts.append(rel_start)
+        self._sizes.append(size)
+        if size > 0:
+            self.total_size += size
+
+    def __iter__(self):
+        start = 0
+        for index in range(len(self._sizes)):
+            end = self._name_ends[index]
+            name = os.fsdecode(bytes(self._names[start:end]))
+            start = end
+            abs_path = os.path.join(self._dirs[self._parents[index]], name)
+            rel_path = abs_path[self._rel_starts[index]:]
+            if os.sep != '/':
+                # path format: \path\file.txt in all platforms
+                rel_path = rel_path.replace(os.sep, '/')
+            yield abs_path, rel_path, self._sizes[index]
+
+    def split(self, count):
+        """split into "count" manifests balanced by bytes.
+
+        Directories are in every manifest, so that every part can be
+        received alone. Manifest without file is dropped.
+        """
+        sizes = self._sizes
+        owners = array('L', bytes(len(sizes) * array('L').itemsize))
+        loads = [(0, index) for index in range(count)]
+        # largest file first to the least loaded part
+        for index in sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True):
+            if sizes[index] < 0:
+                break
+            load, owner = heapq.heappop(loads)
+            owners[index] = owner
+            heapq.heappush(loads, (load + sizes[index], owner))
+        manifests = [Manifest() for _ in range(count)]
+        files = [0] * count
+        for index, (abs_path, rel_path, size) in enumerate(self):
+            rel_start = len(abs_path) - len(rel_path)
+            if size < 0:
+                for manifest in manifests:
+                    manifest.append(abs_path, rel_start, size)
+            else:
+                manifests[owners[index]].append(abs_path, rel_start, size)
+                files[owners[index]] += 1
+        return [manifest for manifest, num in zip(manifests, files) if num > 0] or manifests[:1]
+
+    def exclude(self, names):
+        """new manifest without files in "names" """
+        manifest = Manifest()
+        for abs_path, rel_path, size in self:
+            if size < 0 or rel_path not in names:
+                manifest.append(abs_path, len(abs_path) - len(rel_path), size)
+        return manifest
+
+
+def scan_dir(path):
+    """scan one directory, return (dirs, files).
+
+    "dirs" is list of (name, recurse), "files" is list of (name, size)
+    """
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        # same as os.walk, don't walk into symbolic link of directory
+                        dirs.append((entry.name, not entry.is_symlink()))
+                    else:
+                        files.append((entry.name, entry.stat().st_size))
+                except OSError as err:
+                    logger.warning('Skip "%s": %s' % (entry.path, err))
+    except OSError as err:
+        logger.warning('Skip "%s": %s' % (path, err))
+    return dirs, files
+
+
+def build_manifest(paths, progress=None, workers=None):
+    """list files and walk directories to send, return Manifest.
+
+    Sub directories are scanned in thread pool, and order of output is
+    same as os.walk. "progress" is called with (count, total_size) after
+    every directory.
+    """
+    manifest = Manifest()
+    with ThreadPoolExecutor(max_workers=workers or SCAN_WORKERS) as executor:
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            if not os.path.exists(abs_path):
+                logger.warning('Not found "%s".' % abs_path)
+                continue
+            # rel_path is base name of top path
+            rel_start = len(os.path.join(os.path.dirname(abs_path), ''))
+            if not os.path.isdir(abs_path):
+                manifest.append(abs_path, rel_start, os.path.getsize(abs_path))
+                continue
+            manifest.append(abs_path, rel_start, -1)
+            stack = [(abs_path, executor.submit(scan_dir, abs_path))]
+            while stack:
+                dir_path, future = stack.pop()
+                dirs, files = future.result()
+                children = []
+                for name, recurse in dirs:
+                    sub_path = os.path.join(dir_path, name)
+                    manifest.append(sub_path, rel_start, -1)
+                    if recurse:
+                        children.append((sub_path, executor.submit(scan_dir, sub_path)))
+                for name, size in files:
+                    manifest.append(os.path.join(dir_path, name), rel_start, size)
+                stack.extend(reversed(children))
+                if progress:
+                    progress(len(manifest), manifest.total_size)
+    return manifest
+
+
+def read_paths(f):
+    """read NUL separated paths from binary file "f" as stream"""
+    rest = b''
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        paths = (rest + data).split(b'\0')
+        rest = paths.pop()
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+    if rest:
+        yield os.fsdecode(rest)
+
+
+def read_manifest(f, progress=None):
+    """read NUL separated paths from binary file "f", return Manifest.
+
+    Path is sent as it is given, without leading "/" and "..". Directory
+    is sent as directory entry and is not walked, same as "find -print0".
+    Parent directory is added if it is not listed before.
+    """
+    manifest = Manifest()
+    dirs = set()
+    for path in read_paths(f):
+        rel_path = os.path.splitdrive(os.path.normpath(path))[1].lstrip(os.sep + (os.altsep or ''))
+        while rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            rel_path = rel_path[len(os.pardir) + 1:]
+        if not rel_path or rel_path == os.curdir:
+            continue
+        abs_path = os.path.abspath(path)
+        try:
+            st = os.stat(abs_path)
+        except OSError as err:
+            logger.warning('Skip "%s": %s' % (abs_path, err))
+            continue
+        rel_start = len(abs_path) - len(rel_path)
+        parents = []
+        parent = os.path.dirname(rel_path)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parents.append(parent)
+            parent = os.path.dirname(parent)
+        for parent in reversed(parents):
+            manifest.append(abs_path[:rel_start + len(parent)], rel_start, -1)
+        if stat.S_ISDIR(st.st_mode):
+            if rel_path in dirs:
+                continue
+            dirs.add(rel_path)
+            manifest.append(abs_path, rel_start, -1)
+        else:
+            manifest.append(abs_path, rel_start, st.st_size)
+        if progress and len(manifest) % 1000 == 0:
+            progress(len(manifest), manifest.total_size)
+    return manifest
+
+
+def clone_file(src, dst):
+    """clone file by reflink if file system support it, else copy it.
+
+    Return False if file is copied.
+    """
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+    return False
+
+
+def snapshot_dir(manifest):
+    """directory to create snapshot in, on file system of sent files.
+
+    Clone doesn't work across file systems, parent of first sent file is
+    used if it is writable, else None for default temporary directory.
+    """
+    for abs_path, rel_path, size in manifest:
+        directory = os.path.dirname(abs_path[:len(abs_path) - len(rel_path)]) or os.curdir
+        if os.access(directory, os.W_OK):
+            return directory
+        break
+    return None
+
+
+def snapshot_manifest(manifest, directory, progress=None):
+    """clone files of "manifest" into "directory", return Manifest of clones.
+
+    Files are sent from the snapshot, so that they can't be changed
+    when send. Size is read again from the clone.
+    """
+    snapshot = Manifest()
+    rel_start = len(os.path.join(directory, ''))
+    copied = False
+    for abs_path, rel_path, size in manifest:
+        path = os.path.join(directory, *rel_path.split('/'))
+        try:
+            if size < 0:
+                os.makedirs(path, exist_ok=True)
+                snapshot.append(path, rel_start, -1)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if not clone_file(abs_path, path) and not copied:
+                    copied = True
+                    logger.warning('Snapshot "%s" is copied, not cloned. file system doesn\'t support'
+                                   ' clone or is not same as sent files, see "--snapshot-dir"' % directory)
+                snapshot.append(path, rel_start, os.path.getsize(path))
+        except OSError as err:
+            logger.warning('Skip "%s": %s' % (abs_path, err))
+            continue
+        if progress and len(snapshot) % 1000 == 0:
+            progress(len(snapshot), snapshot.total_size)
+    return snapshot
+
+
+def spool_file(f, path, max_size=None, progress=None):
+    """copy binary stream "f" to file "path", at most "max_size" bytes.
+
+    Dukto and NitroShare need file size in header, so data of pipe is
+    spooled to disk before send. Memory is bounded by read size.
+    """
+    max_size = max_size or SPOOL_SIZE
+    size = 0
+    buff = memoryview(bytearray(SPOOL_READ_SIZE))
+    with open(path, 'wb') as out:
+        while True:
+            count = f.readinto(buff)
+            if not count:
+                break
+            size += count
+            if size > max_size:
+                raise ValueError('Stream is more than spool size: %s' % max_size)
+            out.write(buff[:count])
+            if progress:
+                progress(1, size)
+    return size
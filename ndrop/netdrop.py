@@ -1,21 +1,46 @@
 
 import io
 import sys
+import time
 import argparse
 import logging
 import os.path
 import select
-import hashlib
+import threading
+import tempfile
+import json
 
 from tqdm import tqdm
 
 from . import dukto
 from . import nitroshare
+from .manifest import build_manifest, read_manifest, snapshot_manifest, snapshot_dir, spool_file
+from .fanout import Peer, send_fanout
+from .dedup import ContentIndex, hash_manifest, link_file, safe_path
+from .digest import HashPool, TreeHash, hash_file, digest_line, sum_line, damaged_ranges, SUM_FILES, SUM_HEADER
+from .transport import human_size, file_changed, preallocate_file
 
 
 logger = logging.getLogger(__name__)
 
 
+# partial files in drop directory, they can be resumed by ndrop sender
+JOURNAL_NAME = '.ndrop-journal'
+# file is received into part file, it is renamed when complete
+PART_PREFIX = '.ndrop-'
+PART_SUFFIX = '.part'
+# wait for receiver to write data before check digests
+CHECK_INTERVAL = 0.2
+CHECK_WAIT = 2
+CHECK_TIMEOUT = 60
+
+
+def part_path(path):
+    """part file of "path" in same directory"""
+    dir_path, name = os.path.split(path)
+    return os.path.join(dir_path, PART_PREFIX + name + PART_SUFFIX)
+
+
 class NetDrop(object):
     _name = 'Ndrop'
     _bar = None
@@ -28,29 +53,77 @@ class NetDrop(object):
         )
 
 
+class RecvSession(object):
+    """receive state of one connection: file, digest and process bar"""
+    from_addr = None
+    _file_io = None
+    # part file is renamed to path when file is complete
+    _path = None
+    _part = None
+    _hash = None
+    _bar = None
+    # file data is written by transport
+    _direct = False
+    # resumed file is written from offset
+    _offset = 0
+    _recv_size = 0
+    _file_size = 0
+
+    def __init__(self, from_addr):
+        self.from_addr = from_addr
+
+
 class NetDropServer(NetDrop):
     _name = 'NdropServer'
     _transport = None
-    _md5 = None
-    _file_io = None
-    _bar = None
+    _engine = 'threading'
     _drop_directory = None
     _read_only = False
     _nodes = None
-
-    def __init__(self, addr, mode=None, ssl_ck=None):
+    _sessions = None
+    _lock = None
+    _stdout_lock = None
+    _resumes = None
+    _replies = None
+    _index = None
+    _links = None
+    _hash_pool = None
+    _checksums = None
+    _leaves = None
+    _checksum = False
+    _sum_io = None
+    _journal = None
+    _journal_dirty = False
+
+    def __init__(self, addr, mode=None, ssl_ck=None, max_workers=None, engine=None, io_size=None,
+                 algorithm=None, checksum=False):
         self._transport = []
+        self._engine = engine or self._engine
         if not mode or mode == 'dukto':
-            self._transport.append(dukto.DuktoServer(self, addr, ssl_ck=ssl_ck))
+            self._transport.append(dukto.DuktoServer(
+                self, addr, ssl_ck=ssl_ck, max_workers=max_workers, io_size=io_size))
         if not mode or mode == 'nitroshare':
-            self._transport.append(nitroshare.NitroshareServer(self, addr, ssl_ck=ssl_ck))
+            self._transport.append(nitroshare.NitroshareServer(
+                self, addr, ssl_ck=ssl_ck, max_workers=max_workers, io_size=io_size))
         self._drop_directory = os.path.abspath('./')
         if not os.access(self._drop_directory, os.W_OK):
             self._read_only = True
             logger.warn('No permission to WRITE: %s' % self._drop_directory)
         self._nodes = {}
+        self._sessions = {}
+        self._resumes = {}  # {ip: {name: (offset, hash)}}
+        self._replies = {}  # {addr: (done, drop)} of control request
+        self._links = {}    # {ip: {source: [[name, hard]]}}
+        self._hash_pool = HashPool(algorithm)
+        self._checksums = {}    # {ip: {name: digest}} for ndrop sender to check
+        self._leaves = {}   # {ip: {name: [leaf]}} of tree hash, to find damaged range
+        self._checksum = checksum
+        self._lock = threading.Lock()
+        self._stdout_lock = threading.Lock()
 
     def wait_for_request(self):
+        if self._engine == 'asyncio':
+            return self.wait_for_request_asyncio()
         try:
             for transport in self._transport:
                 transport.wait_for_request()
@@ -63,10 +136,21 @@ class NetDropServer(NetDrop):
             self.quit()
             logger.info('\n-- Quit --')
 
+    def wait_for_request_asyncio(self):
+        """all transports in one event loop, no thread for connection"""
+        # asyncio engine needs python 3.7
+        from . import aio
+        try:
+            aio.serve(self._transport)
+        except KeyboardInterrupt:
+            self.quit()
+            logger.info('\n-- Quit --')
+
     def quit(self):
         for transport in self._transport:
             logger.info('Quit: %s' % transport)
             transport.quit_request()
+        self.flush_journal()
 
     def check_drop_directory(self):
         if os.access(self._drop_directory, os.W_OK):
@@ -76,6 +160,8 @@ class NetDropServer(NetDrop):
         return self._read_only
 
     def saved_to(self, path):
+        self.flush_journal()
+        self._journal = None
         if path == '-':
             self._drop_directory = '-'
             return
@@ -86,81 +172,390 @@ class NetDropServer(NetDrop):
             return
         self._drop_directory = os.path.abspath(path)
 
+    def get_session(self, from_addr):
+        """every connection has its own session, key is peer address"""
+        with self._lock:
+            session = self._sessions.get(from_addr)
+            if session is None:
+                session = self._sessions[from_addr] = RecvSession(from_addr)
+        return session
+
+    def close_session(self, from_addr):
+        with self._lock:
+            return self._sessions.pop(from_addr, None)
+
     def on_recv_file(self, path, from_addr):
         pass
 
-    def recv_feed_file(self,
-                       path, data,
-                       recv_size, file_size,
-                       total_recv_size, total_size,
-                       from_addr):
-        if self._bar is None:   # create process bar for every transfer
+    def open_file(self, session, path, file_size, total_size, from_addr):
+        if session._bar is None:   # create process bar for every transfer
             self.on_recv_file(path, from_addr)
-            self._bar = self.init_bar(total_size)
-        if not self._file_io:  # new file, directory
+            session._bar = self.init_bar(total_size)
+        if not session._file_io:  # new file, directory
+            offset, resume_hash = self.pop_resume(from_addr, path)
             # use current platform sep
             path = path.replace('/', os.sep)
             if self._drop_directory == '-':
-                self._file_io = sys.stdout.buffer
+                # one file at a time to STDOUT. Workers of asyncio engine
+                # are shared by connections, other sender is rejected
+                if not self._stdout_lock.acquire(blocking=self._engine != 'asyncio'):
+                    raise ValueError('STDOUT is written by other sender')
+                session._file_io = sys.stdout.buffer
             elif self.check_drop_directory():
                 logger.warn('No permission WRITING to "%s" and drop all data...' % os.path.join(
                     self._drop_directory, path))
                 # create null file for readonly
                 name = os.devnull
-                self._file_io = open(name, 'wb')
+                session._file_io = open(name, 'wb')
             else:
                 name = os.path.join(self._drop_directory, path)
                 if file_size < 0:    # directory
-                    if not os.path.exists(name):
-                        os.mkdir(name)
+                    # directory may be created by other stream
+                    os.makedirs(name, exist_ok=True)
+                elif offset:
+                    # resumed file, hash of written data
+                    session._path, session._part = name, part_path(name)
+                    session._hash = resume_hash
+                    session._file_io = open(session._part, 'r+b')
+                    session._file_io.truncate(offset)
+                    preallocate_file(session._file_io.fileno(), file_size + offset)
+                    session._file_io.seek(offset)
+                    session._offset = offset
+                    return
                 else:
-                    self._file_io = open(name, 'wb')
-            self._md5 = hashlib.md5()  # create md5 for file
+                    # readable for mmap if write directly
+                    session._path, session._part = name, part_path(name)
+                    session._file_io = open(session._part, 'w+b')
+                    preallocate_file(session._file_io.fileno(), file_size)
+            session._hash = self._hash_pool.new()  # create hash for file
+
+    def recv_file_fileno(self, path, file_size, total_size, from_addr):
+        """file descriptor for transport to write file data directly.
+
+        Data written by transport is still passed to "recv_feed_file", only
+        for hash and process bar. None if output to STDOUT or no permission.
+        """
+        if self._drop_directory == '-':
+            return None
+        session = self.get_session(from_addr)
+        self.open_file(session, path, file_size, total_size, from_addr)
+        if self._read_only or session._offset:
+            return None
+        session._file_io.flush()
+        session._direct = True
+        return session._file_io.fileno()
+
+    def recv_feed_file(self,
+                       path, data,
+                       recv_size, file_size,
+                       total_recv_size, total_size,
+                       from_addr):
+        session = self.get_session(from_addr)
+        self.open_file(session, path, file_size, total_size, from_addr)
 
+        session._file_size = file_size
         if file_size < 0:
             return
-        self._file_io.write(data)
-        self._bar.update(len(data))
-        self._md5.update(data)
+        session._recv_size = recv_size
+        if isinstance(data, list):  # batch of packets
+            session._file_io.writelines(data)
+            for chunk in data:
+                session._hash.update(chunk)
+            session._bar.update(sum(len(chunk) for chunk in data))
+        else:
+            if not session._direct:
+                session._file_io.write(data)
+            session._bar.update(len(data))
+            session._hash.update(data)
 
     def recv_finish_file(self, path, from_addr):
         """接受当前文件完成"""
+        session = self.get_session(from_addr)
+        if session._bar is None:    # nothing received
+            return
         if self._drop_directory == '-':
-            self._file_io.flush()
+            if session._file_io:
+                try:
+                    session._file_io.flush()
+                finally:
+                    session._file_io = None
+                    self._stdout_lock.release()
         else:
+            name = path
             path = path.replace('/', os.sep)
-            if self._file_io:
-                self._file_io.close()
-                self._file_io = None
-                digest = self._md5.hexdigest()
-                self._bar.write('%s  %s' % (digest, path), file=sys.stderr)
-                self._md5 = None
+            if session._file_io:
+                complete = session._recv_size >= session._file_size
+                if not complete and session._part:
+                    # drop preallocated space, written data is kept to resume
+                    session._file_io.flush()
+                    session._file_io.truncate(session._offset + session._recv_size)
+                session._file_io.close()
+                session._file_io = None
+                session._direct = False
+                if complete and session._part:
+                    # readers only see complete file
+                    os.replace(session._part, session._path)
+                session._path = session._part = None
+                digest = session._hash.hexdigest()
+                if not complete:   # abort
+                    self.update_journal(name, {
+                        'size': session._offset + session._file_size,
+                        'written': session._offset + session._recv_size,
+                        'hash': self._hash_pool.algorithm,
+                        'digest': digest,
+                    })
+                    session._bar.write('Partial: %s' % path, file=sys.stderr)
+                else:
+                    self.update_journal(name, None)
+                    session._bar.write(digest_line(digest, path), file=sys.stderr)
+                    if self._index and self._hash_pool.algorithm == 'md5':
+                        self._index.add(name, digest)
+                    if isinstance(session._hash, TreeHash):
+                        self.add_digest(from_addr, name, digest, session._hash.leaves())
+                    else:
+                        self.add_digest(from_addr, name, digest)
+                    self.create_links(from_addr, name)
+                session._hash = None
+                session._offset = session._recv_size = session._file_size = 0
             elif self._read_only:
                 pass
-            else:   # directory
+            elif session._file_size < 0:   # directory
                 if not path.endswith(os.sep):
                     path += os.sep
-                self._bar.write('%s' % (path), file=sys.stderr)
+                session._bar.write('%s' % (path), file=sys.stderr)
+                session._file_size = 0
 
     def recv_finish(self, from_addr, err):
         """此次传输任务全部完成"""
-        if self._bar is not None:
-            self._bar.close()
+        session = self.close_session(from_addr)
+        with self._lock:
+            done, drop = self._replies.pop(from_addr, (None, None))
+        if drop is not None:    # reply of control request is not sent
+            drop()
+        if session is not None and session._file_io:
+            # file is not finished, release STDOUT for other senders
+            if self._drop_directory == '-':
+                session._file_io = None
+                self._stdout_lock.release()
+            else:
+                session._file_io.close()
+                session._file_io = None
+        if session is not None and session._bar is not None:
+            session._bar.close()
             logger.info(err)
-            self._bar = None
+            session._bar = None
+        if self._index:
+            self._index.save()
+        self.flush_journal()
+
+    def add_digest(self, from_addr, name, digest, leaves=None):
+        """keep digest for sender to check, write it to checksum file"""
+        if digest is None:
+            return
+        with self._lock:
+            digests = self._checksums.get(from_addr[0])
+            if digests is not None:
+                digests[name] = digest
+                if leaves and len(leaves) > 1:
+                    self._leaves[from_addr[0]][name] = leaves
+            if not self._checksum or self._read_only:
+                return
+            if self._sum_io is None:
+                path = os.path.join(self._drop_directory, SUM_FILES[self._hash_pool.algorithm])
+                self._sum_io = open(path, 'a', encoding='utf-8')
+                if self._sum_io.tell() == 0:
+                    self._sum_io.write(SUM_HEADER % self._hash_pool.algorithm + '\n')
+            self._sum_io.write(sum_line(digest, name) + '\n')
+            self._sum_io.flush()
+
+    def check_digests(self, files, from_addr):
+        """compare digests of sender with received files.
+
+        Sender closes connection before all data is written, so it asks
+        again for missing files while any connection of it is "busy".
+        """
+        ip = from_addr[0]
+        with self._lock:
+            digests = self._checksums.get(ip, {})
+            mismatch = sorted(name for name, digest in files.items()
+                              if name in digests and digests[name] != digest)
+            missing = sorted(name for name in files if name not in digests)
+            busy = any(addr[0] == ip for addr in self._sessions)
+            # sender finds damaged range by leaves
+            leaves = self._leaves.get(ip, {})
+            leaves = {name: [leaf.hex() for leaf in leaves[name]] for name in mismatch if name in leaves}
+            if not missing:
+                self._checksums.pop(ip, None)
+                self._leaves.pop(ip, None)
+        for name in mismatch:
+            logger.error('Mismatch: %s' % name)
+        if not missing:
+            logger.info('Checked %s files from %s' % (len(digests), ip))
+        return {'mismatch': mismatch, 'missing': missing, 'busy': busy, 'leaves': leaves}
+
+    def load_journal(self):
+        """journal in memory, it is read from drop directory once"""
+        if self._journal is None:
+            try:
+                with open(os.path.join(self._drop_directory, JOURNAL_NAME)) as f:
+                    self._journal = json.load(f)
+            except (OSError, ValueError):
+                self._journal = {}
+        return self._journal
+
+    def update_journal(self, name, entry):
+        """add partial file, remove it if "entry" is None.
+
+        Partial file is written to disk at once to resume after crash,
+        complete file is removed in memory and written at end of transfer.
+        """
+        if self._drop_directory == '-' or self._read_only:
+            return
+        with self._lock:
+            journal = self.load_journal()
+            if entry is None:
+                if journal.pop(name, None) is not None:
+                    self._journal_dirty = True
+                return
+            journal[name] = entry
+            self._journal_dirty = True
+            self.save_journal()
+
+    def flush_journal(self):
+        with self._lock:
+            if self._journal_dirty:
+                self.save_journal()
+
+    def save_journal(self):
+        """write journal, caller holds lock"""
+        path = os.path.join(self._drop_directory, JOURNAL_NAME)
+        try:
+            if self._journal:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self._journal, f)
+                os.replace(path + '.tmp', path)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as err:
+            logger.error('Failed to write journal: %s' % err)
+        else:
+            self._journal_dirty = False
+
+    def pop_resume(self, from_addr, name):
+        """(offset, hash of written data) of file resumed by sender, offset is 0 if not"""
+        with self._lock:
+            return self._resumes.get(from_addr[0], {}).pop(name, (0, None))
+
+    def create_links(self, from_addr, name):
+        """link files with same content as received file "name" """
+        with self._lock:
+            links = self._links.get(from_addr[0], {}).pop(name, [])
+        for link, hard in links:
+            try:
+                link_file(safe_path(self._drop_directory, name),
+                          safe_path(self._drop_directory, link), hard)
+            except (OSError, ValueError) as err:
+                logger.error('Failed to link "%s": %s' % (link, err))
+                continue
+            logger.info('%s => %s' % (name, link))
+
+    def after_reply(self, from_addr, done, drop=None):
+        """run "done" when reply of control request is sent, else "drop" """
+        with self._lock:
+            self._replies[from_addr] = (done, drop)
+
+    def recv_control_replied(self, from_addr):
+        with self._lock:
+            done, drop = self._replies.pop(from_addr, (None, None))
+        if done is not None:
+            done()
+
+    def dedup(self, message, from_addr):
+        """rebuild files from drop directory, return names not to be sent.
+
+        Files are rebuilt into temporary files, and moved in place after
+        sender gets reply.
+        """
+        if self._drop_directory == '-' or self._read_only:
+            return {'files': [], 'links': []}
+        # scan and hash files without lock, other senders are still received
+        with self._lock:
+            index = self._index
+        if index is None:
+            index = ContentIndex(self._drop_directory)
+            with self._lock:
+                if self._index is None:
+                    self._index = index
+                index = self._index
+        found = index.prepare(index.find(message['files']))
+        links = {}
+        for name, (source, hard) in message['links'].items():
+            links.setdefault(source, []).append([name, hard])
+
+        def done():
+            index.commit(found)
+            with self._lock:
+                self._links[from_addr[0]] = links
+            for name in found:
+                self.create_links(from_addr, name)
+            logger.info('Dedup %s files from %s' % (len(found), from_addr[0]))
+
+        self.after_reply(from_addr, done, lambda: index.drop(found))
+        return {'files': list(found), 'links': list(message['links'])}
+
+    def recv_control(self, message, from_addr):
+        """request of ndrop sender before transfer"""
+        if message.get('op') == 'journal':
+            with self._lock:
+                return {'files': dict(self.load_journal())}
+        elif message.get('op') == 'resume':
+            # only accept offset of partial file in journal
+            with self._lock:
+                journal = dict(self.load_journal())
+            files = {}
+            resumes = {}
+            for name, offset in message['files'].items():
+                path = part_path(os.path.join(self._drop_directory, name.replace('/', os.sep)))
+                if name in journal and journal[name]['written'] == offset and \
+                        os.path.isfile(path) and os.path.getsize(path) >= offset:
+                    # hash written data before reply, sender doesn't wait for it when stream
+                    resumes[name] = (offset, self._hash_pool.new(
+                        hash_file(path, offset, self._hash_pool.algorithm)))
+                    files[name] = offset
+
+            def done():
+                with self._lock:
+                    self._resumes[from_addr[0]] = resumes
+                logger.info('Resume %s files from %s' % (len(files), from_addr[0]))
+
+            self.after_reply(from_addr, done)
+            return {'files': files}
+        elif message.get('op') == 'dedup':
+            return self.dedup(message, from_addr)
+        elif message.get('op') == 'checksum':
+            # keep digests of files from sender until it checks them
+            with self._lock:
+                self._checksums[from_addr[0]] = {}
+                self._leaves[from_addr[0]] = {}
+            return {'hash': self._hash_pool.algorithm}
+        elif message.get('op') == 'verify':
+            return self.check_digests(message['files'], from_addr)
+        return {'error': 'Unknown request: %s' % message.get('op')}
 
     def recv_feed_text(self, data, from_addr):
-        if not self._file_io:
-            self._file_io = io.BytesIO()
-        self._file_io.write(data)
+        session = self.get_session(from_addr)
+        if not session._file_io:
+            session._file_io = io.BytesIO()
+        session._file_io.write(data)
 
     def recv_finish_text(self, from_addr):
         """接受当前文本完成"""
-        data = self._file_io.getvalue()
+        session = self.get_session(from_addr)
+        data = session._file_io.getvalue()
         text = data.decode('utf-8')
         logger.info('TEXT: %s' % text)
-        self._file_io.close()
-        self._file_io = None
+        session._file_io.close()
+        session._file_io = None
         return text
 
     def get_nodes(self):
@@ -188,84 +583,375 @@ class NetDropClient(NetDrop):
     _name = 'NdropClient'
     _transport = None
     _bar = None
-    _md5 = None
-
-    def __init__(self, addr, mode=None, ssl_ck=None):
+    _hashes = None
+    _hash_pool = None
+    _streams = 1
+    _change_policy = 'truncate'
+    _snapshot_dir = None
+    _spool_size = None
+    _stdin_name = 'stdin'
+    _compress = False
+    _resume = False
+    _offsets = None
+    _dedup = False
+    _checksum = False
+    _digests = None
+    _leaves = None
+    _err = None
+
+    def __init__(self, addr, mode=None, ssl_ck=None, io_size=None, streams=None, change_policy=None,
+                 spool_size=None, stdin_name=None, compress=False, resume=False, dedup=False,
+                 algorithm=None, checksum=False, snapshot_dir=None):
+        """addr: ip[:port][@mode], multiple destinations are separated by comma"""
         self.addr = addr
         self.mode = mode
+        self._ssl_ck = ssl_ck
+        self._io_size = io_size
+        self._streams = streams or self._streams
+        self._change_policy = change_policy or self._change_policy
+        self._snapshot_dir = snapshot_dir or self._snapshot_dir
+        self._spool_size = spool_size or self._spool_size
+        self._stdin_name = stdin_name or self._stdin_name
+        self._compress = compress
+        self._resume = resume
+        self._dedup = dedup
+        self._checksum = checksum
+        self._hashes = {}   # one hash every file
+        self._hash_pool = HashPool(algorithm)
+        self._lock = threading.Lock()
+        self._errors = []
+        self._destinations = []
+        for dest in addr.split(','):
+            dest_addr, _, dest_mode = dest.partition('@')
+            self._destinations.append((dest_addr, dest_mode or mode))
+        self._transport = self.create_transport(*self._destinations[0])
+
+    def create_transport(self, addr, mode):
         if mode == 'dukto':
-            self._transport = dukto.DuktoClient(self, addr, ssl_ck=ssl_ck)
+            transport = dukto.DuktoClient(self, addr, ssl_ck=self._ssl_ck, io_size=self._io_size)
         elif mode == 'nitroshare':
-            self._transport = nitroshare.NitroshareClient(self, addr, ssl_ck=ssl_ck)
+            transport = nitroshare.NitroshareClient(self, addr, ssl_ck=self._ssl_ck, io_size=self._io_size)
         else:
             raise ValueError('unknown mode: %s' % mode)
+        transport.set_change_policy(self._change_policy)
+        transport.set_compress(self._compress)
+        transport.set_offsets(self._offsets)
+        return transport
 
     def __str__(self):
         return '%s [%s]' % (self.addr, self.mode)
 
+    def scan_files(self, build, *args):
+        """build manifest with scan process bar"""
+        scan_bar = tqdm(desc='Scan', unit=' files', leave=False)
+
+        def progress(count, total_size):
+            scan_bar.update(count - scan_bar.n)
+            scan_bar.set_postfix_str(human_size(total_size), refresh=False)
+
+        manifest = build(*args, progress=progress)
+        scan_bar.close()
+        return manifest
+
     def send_files(self, files):
-        all_files = []
-        total_size = 0
-        for f in files:
-            abs_path = os.path.abspath(f)
-            if not os.path.exists(abs_path):
-                logger.warn(f'Not found "{abs_path}".')
-                continue
-            base_path = os.path.dirname(abs_path)
-            rel_path = os.path.relpath(abs_path, base_path)
+        """"-" in files is stdin, it is spooled and sent as "stdin_name"."""
+        if '-' not in files:
+            self.send_manifest(self.scan_files(build_manifest, files))
+            return
+        with tempfile.TemporaryDirectory(prefix='ndrop-') as tmp_dir:
+            path = os.path.join(tmp_dir, self._stdin_name)
+            try:
+                self.scan_files(spool_file, sys.stdin.buffer, path, self._spool_size)
+            except ValueError as err:
+                logger.error(err)
+                return
+            files = [path if f == '-' else f for f in files]
+            self.send_manifest(self.scan_files(build_manifest, files))
+
+    def send_files_from(self, path):
+        """send files listed in NUL separated file, "-" is stdin"""
+        if path == '-':
+            manifest = self.scan_files(read_manifest, sys.stdin.buffer)
+        else:
+            with open(path, 'rb') as f:
+                manifest = self.scan_files(read_manifest, f)
+        self.send_manifest(manifest)
+
+    def send_manifest(self, manifest):
+        if len(manifest) == 0:
+            return
+        if self._change_policy == 'snapshot':
+            # send clones, files may be changed when send
+            directory = self._snapshot_dir or snapshot_dir(manifest)
+            with tempfile.TemporaryDirectory(prefix='.ndrop-', dir=directory) as tmp_dir:
+                self.transfer_manifest(self.scan_files(snapshot_manifest, manifest, tmp_dir))
+        else:
+            self.transfer_manifest(manifest)
 
-            if os.path.isdir(abs_path):
-                size = -1
+    def transfer_manifest(self, manifest):
+        if len(self._destinations) > 1:
+            self._bar = self.init_bar(manifest.total_size)
+            self.send_fanout(manifest)
+            return
+        if self._dedup:
+            manifest = self.dedup_manifest(manifest)
+            if len(manifest) == 0:
+                logger.info('All files are in receiver')
+                return
+        if self._checksum:
+            self.start_checksum()
+        if self._resume:
+            self._offsets = self.resume_offsets(manifest)
+            self._transport.set_offsets(self._offsets)
+        # always create process bar
+        self._bar = self.init_bar(self.send_size(manifest))
+        streams = self._streams
+        transport = self._transport
+        if streams > 1 and not transport.query_features(transport._udp_address):
+            # stock receiver may reject or queue concurrent transfers
+            logger.info('Receiver is not ndrop, send in one stream')
+            streams = 1
+        if streams < 2:
+            self._errors = [None]
+            self.send_stream(transport, manifest)
+        else:
+            # every stream is a new transfer of receiver
+            manifests = manifest.split(streams)
+            self._errors = [None] * len(manifests)
+            threads = []
+            for sub_manifest in manifests:
+                thread = threading.Thread(
+                    target=self.send_stream,
+                    args=(self.create_transport(*self._destinations[0]), sub_manifest),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        if self._digests is not None:
+            self.check_digests()
+
+    def send_stream(self, transport, manifest):
+        """send files in one connection, it always reports "send_finish" """
+        try:
+            transport.send_files(self.send_size(manifest), manifest)
+        except Exception as err:
+            # transport logs error
+            self.send_finish('Failed to send Files: %s' % err)
+
+    def send_size(self, manifest):
+        """total size without data of resumed files"""
+        if not self._offsets:
+            return manifest.total_size
+        return manifest.total_size - sum(self._offsets.get(name, 0) for _, name, _ in manifest)
+
+    def resume_offsets(self, manifest):
+        """ask receiver for partial files, return {name: offset}.
+
+        Written data is checked by hash of receiver, and hash is continued
+        when send.
+        """
+        transport = self._transport
+        if 'resume' not in transport.query_features(transport._udp_address):
+            return {}
+        try:
+            journal = transport.request({'op': 'journal'}).get('files', {})
+            offsets = {}
+            for path, name, size in manifest:
+                entry = journal.get(name)
+                if not entry or entry['size'] != size or not 0 < entry['written'] < size or \
+                        not entry.get('digest'):
+                    continue
+                hash_obj = hash_file(path, entry['written'], entry['hash'])
+                if hash_obj.hexdigest() == entry['digest']:
+                    offsets[name] = entry['written']
+                    if entry['hash'] != self._hash_pool.algorithm:
+                        hash_obj = hash_file(path, entry['written'], self._hash_pool.algorithm)
+                    self._hashes[name] = self._hash_pool.new(hash_obj)
+            if offsets:
+                offsets = transport.request({'op': 'resume', 'files': offsets},
+                                            size=sum(offsets.values())).get('files', {})
+        except (OSError, ValueError) as err:
+            logger.error('Failed to resume: %s' % err)
+            offsets = {}
+        for name in list(self._hashes):
+            if name not in offsets:
+                del self._hashes[name]
+        if offsets:
+            logger.info('Resume %s files, skip %s' % (len(offsets), human_size(sum(offsets.values()))))
+        return offsets
+
+    def dedup_manifest(self, manifest):
+        """ask receiver to rebuild files from its content, return manifest to send.
+
+        Hard links and files with same content are sent once, receiver
+        links them after the first is received.
+        """
+        transport = self._transport
+        if 'dedup' not in transport.query_features(transport._udp_address):
+            return manifest
+        files, links = hash_manifest(manifest)
+        if not files and not links:
+            return manifest
+        try:
+            reply = transport.request({'op': 'dedup', 'files': files, 'links': links})
+        except (OSError, ValueError) as err:
+            logger.error('Failed to dedup: %s' % err)
+            return manifest
+        # only links receiver creates are not sent
+        found = reply.get('files', [])
+        links = reply.get('links', [])
+        if found or links:
+            logger.info('Dedup %s files, %s links' % (len(found), len(links)))
+        return manifest.exclude(set(found) | set(links))
+
+    def start_checksum(self):
+        """ask receiver to keep digests of files, hash same as receiver"""
+        transport = self._transport
+        if 'checksum' not in transport.query_features(transport._udp_address):
+            return
+        try:
+            algorithm = transport.request({'op': 'checksum'}).get('hash')
+        except (OSError, ValueError) as err:
+            logger.error('Failed to check: %s' % err)
+            return
+        if algorithm in (None, 'none'):
+            logger.warning('No hash on receiver, files are not checked')
+            return
+        if algorithm != self._hash_pool.algorithm:
+            logger.info('Hash files by %s, same as receiver' % algorithm)
+            self._hash_pool = HashPool(algorithm)
+        self._digests = {}
+        self._leaves = {}
+
+    def check_digests(self):
+        """send digests of sent files, receiver compares them with received files.
+
+        Missing files are asked again until receiver writes all data.
+        """
+        files = self._digests
+        mismatch = []
+        leaves = {}
+        start = time.time()
+        while True:
+            try:
+                reply = self._transport.request({'op': 'verify', 'files': files})
+            except (OSError, ValueError) as err:
+                logger.error('Failed to check: %s' % err)
+                return
+            mismatch.extend(reply.get('mismatch', []))
+            leaves.update(reply.get('leaves', {}))
+            missing = reply.get('missing', [])
+            elapsed = time.time() - start
+            if not missing or elapsed > CHECK_TIMEOUT or (not reply.get('busy') and elapsed > CHECK_WAIT):
+                break
+            files = {name: files[name] for name in missing}
+            time.sleep(CHECK_INTERVAL)
+        for name in mismatch:
+            if name in leaves and name in self._leaves:
+                ranges = damaged_ranges([leaf.hex() for leaf in self._leaves[name]], leaves[name])
+                logger.error('Mismatch: %s, damaged bytes: %s' % (
+                    name, ', '.join('%s-%s' % r for r in ranges)))
             else:
-                size = os.path.getsize(abs_path)
-                total_size += size
-            all_files.append((abs_path, rel_path, size))
-
-            if size == -1:
-                for root, dirs, files in os.walk(abs_path):
-                    for name in dirs:
-                        sub_abs_path = os.path.join(root, name)
-                        rel_path = os.path.relpath(sub_abs_path, base_path)
-                        # path format: \path\file.txt in all platforms
-                        rel_path = rel_path.replace('\\', '/')
-                        all_files.append((sub_abs_path, rel_path, -1))
-
-                    for name in files:
-                        sub_abs_path = os.path.join(root, name)
-                        rel_path = os.path.relpath(sub_abs_path, base_path)
-                        rel_path = rel_path.replace('\\', '/')
-                        size = os.path.getsize(sub_abs_path)
-                        total_size += size
-                        all_files.append((sub_abs_path, rel_path, size))
-
-        if all_files:
-            # always create process bar
-            self._bar = self.init_bar(total_size)
-            self._transport.send_files(total_size, all_files)
+                logger.error('Mismatch: %s' % name)
+        for name in missing:
+            logger.error('Not received: %s' % name)
+        logger.info('Checked %s files, %s mismatch' % (len(self._digests) - len(missing), len(mismatch)))
+
+    def send_fanout(self, manifest):
+        """read file once and send it to all destinations"""
+        peers = []
+        for addr, mode in self._destinations:
+            peers.append(Peer(
+                '%s [%s]' % (addr, mode), self.create_transport(addr, mode),
+                manifest.total_size, len(manifest),
+            ))
+        self._errors = [None]
+        try:
+            send_fanout(self, peers, manifest, self._transport._read_size)
+        except KeyboardInterrupt:
+            pass
+        except Exception as err:
+            logger.error(err)
+        done = 0
+        for peer in peers:
+            if peer.err == 'done':
+                done += 1
+            self._bar.write('%s: %s' % (peer.name, peer.err), file=sys.stderr)
+        if done == len(peers):
+            self.send_finish('done')
+        else:
+            self.send_finish('Failed to send to %s of %s destinations' % (len(peers) - done, len(peers)))
+
+    def file_changed(self, name, size, new_size):
+        return file_changed(self._change_policy, name, size, new_size)
 
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
         if file_size > -1:
-            if not self._md5:  # one md5 every file
-                self._md5 = hashlib.md5()
-            self._bar.update(len(data))
-            self._md5.update(data)
+            with self._lock:
+                hash_obj = self._hashes.get(path)
+                if hash_obj is None:
+                    hash_obj = self._hashes[path] = self._hash_pool.new()
+                self._bar.update(len(data))
+            hash_obj.update(data)
+
+    def send_feed_files(self, files, total_send_size, total_size):
+        lines = []
+        size = 0
+        for path, data, file_size in files:
+            if file_size > -1:
+                size += len(data)
+                digest = self._hash_pool.hexdigest(data)
+                lines.append(digest_line(digest, path))
+                if self._digests is not None and digest:
+                    self._digests[path] = digest
+            elif path.endswith('/'):
+                lines.append(path)
+            else:
+                lines.append(path + '/')
+        with self._lock:
+            self._bar.update(size)
+            self._bar.write('\n'.join(lines), file=sys.stderr)
 
     def send_finish_file(self, path):
-        if self._md5:  # file
-            digest = self._md5.hexdigest()
-            self._md5 = None
-            self._bar.write('%s  %s' % (digest, path), file=sys.stderr)
-        else:  # directory
-            if not path.endswith('/'):
-                path += '/'
-            self._bar.write('%s' % (path), file=sys.stderr)
+        with self._lock:
+            hash_obj = self._hashes.pop(path, None)
+        # wait for hash thread out of lock
+        digest = hash_obj.hexdigest() if hash_obj else None
+        with self._lock:
+            if hash_obj:  # file
+                self._bar.write(digest_line(digest, path), file=sys.stderr)
+                if self._digests is not None and digest:
+                    self._digests[path] = digest
+                    if isinstance(hash_obj, TreeHash):
+                        self._leaves[path] = hash_obj.leaves()
+            else:  # directory
+                if not path.endswith('/'):
+                    path += '/'
+                self._bar.write('%s' % (path), file=sys.stderr)
 
     def send_finish(self, err):
+        """called by every stream, close process bar when all are finished"""
+        with self._lock:
+            if None in self._errors:    # streams of transfer
+                self._errors[self._errors.index(None)] = err
+                if None in self._errors:
+                    return
+                errors = [e for e in self._errors if e != 'done']
+                err = errors[0] if errors else 'done'
+            if not self.failed():   # keep first error, e.g. TEXT to destinations
+                self._err = err
         if self._bar is not None:
             self._bar.close()
             logger.info(err)
             self._bar = None
 
+    def failed(self):
+        """True if sending is failed"""
+        return self._err not in (None, 'done')
+
     def send_text(self, text):
         logger.info('Send TEXT...')
-        self._transport.send_text(text)
+        for addr, mode in self._destinations:
+            self.create_transport(addr, mode).send_text(text)
@@ -1,4 +1,3 @@
-import sys
 import datetime
 import time
 import logging
@@ -11,9 +10,12 @@ import ssl
 import uuid
 import json
 
-from .transport import Transport, \
-    get_broadcast_address, CHUNK_SIZE, set_chunk_size, \
+from .transport import Transport, ThreadPoolTCPServer, RecvBuffer, BUFFER_POOL, IOV_MAX, SEND_BUFFER_SIZE, \
+    ReadAhead, fit_chunks, zero_chunks, sendmsg_all, prefetch_files, advise_file, \
+    FEATURES, FEATURE_QUERY, get_broadcast_address, \
     get_platform_name, get_platform_system
+from .compress import FEATURE as COMPRESS_FEATURE, CompressWriter, CompressedPacket
+from .extension import unwrap_packet
 from .about import get_system_symbol
 
 
@@ -29,6 +31,13 @@ STATUS = {
     'data': 2,
 }
 
+# size, type. size = sizeof(type + data)
+FRAME_HEADER = struct.Struct('<lb')
+# file data frames in one sendmsg
+SENDMSG_FRAMES = 16
+# send file in one frame with prefetched data if file size is less than it
+SMALL_FILE_SIZE = 1024 * 64
+
 
 class Packet():
     _status = STATUS['idle']
@@ -58,6 +67,10 @@ class Packet():
                 agent.say_hello((client_address[0], agent._udp_port))
                 agent.add_node(client_address[0], node)
 
+    def unpack_features(self, data):
+        """ndrop extensions in hello"""
+        return json.loads(data.decode('utf-8')).get('ndrop', [])
+
     def pack_success(self):
         data = bytearray()
         data.extend(int(1).to_bytes(4, byteorder='little', signed=True))
@@ -86,125 +99,121 @@ class Packet():
         data.extend(bdata)
         return data
 
-    def pack_files(self, agent, total_size, files):
+    def pack_file_header(self, name, size):
+        """file header"""
+        jdata = {}
+        jdata['name'] = name
+        if size == -1:
+            jdata['directory'] = True
+        else:
+            jdata['directory'] = False
+            jdata['size'] = '%s' % size
+        jdata['created'] = ''
+        jdata['last_modified'] = ''
+        jdata['last_read'] = ''
+        bdata = json.dumps(jdata).encode('utf-8')
+
+        # packet format
+        # L    B   B * (size - 1)
+        # size tag data
         data = bytearray()
-        total_send_size = 0
-        transfer_abort = False
-        for path, name, size in files:
-            # file header
-            jdata = {}
-            jdata['name'] = name
-            if size == -1:
-                jdata['directory'] = True
-            else:
-                jdata['directory'] = False
-                jdata['size'] = '%s' % size
-            jdata['created'] = ''
-            jdata['last_modified'] = ''
-            jdata['last_read'] = ''
-            bdata = json.dumps(jdata).encode('utf-8')
-
-            # packet format
-            # L    B   B * (size - 1)
-            # size tag data
-            data.extend((len(bdata) + 1).to_bytes(4, byteorder='little', signed=True))
-            data.append(0x02)
-            data.extend(bdata)
-            if len(data) >= CHUNK_SIZE:
-                yield data[:CHUNK_SIZE]
-                del data[:CHUNK_SIZE]
+        data.extend((len(bdata) + 1).to_bytes(4, byteorder='little', signed=True))
+        data.append(0x02)
+        data.extend(bdata)
+        return data
 
-            send_size = 0
-            if size < 0:    # directory
-                agent.send_feed_file(
-                    name, None,
-                    send_size, -1, total_send_size, total_size,
-                )
-            elif size == 0:
-                agent.send_feed_file(
-                    name, b'',
-                    send_size, 0, total_send_size, total_size,
-                )
-            else:
-                file_changed = False
-                with open(path, 'rb') as f:
-                    while not file_changed:
-                        chunk = f.read(CHUNK_SIZE - len(data))
-                        if not chunk:
-                            if (len(data) + 128) >= CHUNK_SIZE:
-                                yield data[:CHUNK_SIZE]
-                                del data[:CHUNK_SIZE]
-                            break
-                        if (send_size + len(chunk)) > size:
-                            file_changed = True
-                            # correct size
-                            chunk = chunk[:size - send_size]
-                            logger.error('File Changed: [%s] %s => %s.' % (name, size, send_size))
-                            cont = input('Drop data and continue? [Yes/No]')
-                            if cont != 'Yes':
-                                transfer_abort = True
-                        # binary header, every binary packet is less than CHUNK_SIZE
-                        data.extend((len(chunk) + 1).to_bytes(4, byteorder='little', signed=True))
-                        data.append(0x03)
+    def pack_data_header(self, size):
+        """binary header of "size" bytes file data"""
+        return FRAME_HEADER.pack(size + 1, 0x03)
+
+    def pack_files(self, agent, total_size, files, offsets=None):
+        """"offsets" is {name: offset} of resumed files, they are sent from offset"""
+        data = bytearray()
+        total_send_size = 0
+        offsets = offsets or {}
+        # read file data in thread when send
+        reader = ReadAhead(files, offsets=offsets)
+        try:
+            for path, name, size in files:
+                offset = offsets.get(name, 0)
+                size -= offset
+                data.extend(self.pack_file_header(name, size))
+                # read size may be tuned when send
+                if len(data) >= agent._read_size:
+                    yield data
+                    data = bytearray()
+
+                send_size = 0
+                if size < 0:    # directory
+                    agent.send_feed_file(
+                        name, None,
+                        send_size, -1, total_send_size, total_size,
+                    )
+                elif size == 0:
+                    agent.send_feed_file(
+                        name, b'',
+                        send_size, 0, total_send_size, total_size,
+                    )
+                else:
+                    chunks = reader.chunks(path, size, offset)
+                    for chunk in fit_chunks(agent.file_changed, path, name, size, chunks, offset):
                         send_size += len(chunk)
                         total_send_size += len(chunk)
                         agent.send_feed_file(
                             name, chunk,
                             send_size, size, total_send_size, total_size,
                         )
-                        data.extend(chunk)
-                        # send if packet_size more than chunk_size
-                        if len(data) >= CHUNK_SIZE:
-                            yield data[:CHUNK_SIZE]
-                            del data[:CHUNK_SIZE]
-            agent.send_finish_file(name)
-            if transfer_abort:
-                break
-        if len(data) > 0:
-            yield data
-            data.clear()
-        if transfer_abort:
-            sys.exit('Transfer Abort!!!')
+                        # binary header, every binary packet is less than read size
+                        chunk_size = agent._read_size
+                        for offset in range(0, len(chunk), chunk_size):
+                            packet = chunk[offset:offset + chunk_size]
+                            data.extend(self.pack_data_header(len(packet)))
+                            data.extend(packet)
+                            # send if packet_size more than chunk_size
+                            if len(data) >= chunk_size:
+                                yield data
+                                data = bytearray()
+                agent.send_finish_file(name)
+            if len(data) > 0:
+                yield data
+        finally:
+            reader.close()
 
     def unpack_tcp(self, agent, data, from_addr):
-        while len(data) > 0:
+        """parse RecvBuffer "data" by its read cursor."""
+        while len(data) >= FRAME_HEADER.size:
+            size, typ = data.peek(FRAME_HEADER)
+            # 4    1   ...
+            # size tag data
+            # size = sizeof(tag + data)
+            if size > (len(data) - 4):    # wait for more packet data
+                return
+            if self._status == STATUS['data']:
+                if typ != 0x03:
+                    raise ValueError('Error Type: %s' % typ)
+                if self.unpack_data(agent, data, from_addr):
+                    return True
+                continue
+            data.consume(FRAME_HEADER.size)
+            size -= 1
+            body = data.read(size)
             if self._status == STATUS['idle']:  # transfer header
-                if len(data) < 5:
-                    return
-                size, typ = struct.unpack('<lb', data[:5])
-                # 4    1   ...
-                # size tag data
-                # size = sizeof(tag + data)
-                if size > (len(data) - 4):
-                    return
-                del data[:5]
-                size -= 1
                 if size == 0 and typ == 0x00:
                     return
                 elif size > 0 and typ == 0x01:
-                    message = data[:size].decode('utf-8')
-                    del data[:size]
+                    message = str(body, 'utf-8')
                     logger.info('Error: %s' % message)
                     return
                 elif typ == 0x02:   # json, transfer header
-                    jdata = json.loads(data[:size])
-                    del data[:size]
+                    jdata = json.loads(bytes(body))
                     if 'count' not in jdata:
                         raise ValueError('Error: %s' % jdata)
                     self._total_size = int(jdata['size'])
                     self._record = int(jdata['count'])
                     self._status = STATUS['header']
             elif self._status == STATUS['header']:  # json, file header
-                if len(data) < 5:
-                    return
-                size, typ = struct.unpack('<lb', data[:5])
-                if size > (len(data) - 4):
-                    return
-                del data[:5]
-                size -= 1
                 if typ == 0x02:   # json
-                    jdata = json.loads(data[:size])
-                    del data[:size]
+                    jdata = json.loads(bytes(body))
                     if 'directory' not in jdata:  # file header
                         raise ValueError('Error: %s' % jdata)
                     self._recv_file_size = 0
@@ -237,33 +246,47 @@ class Packet():
                             self._status = STATUS['header']
                 else:
                     raise ValueError('Error Type: %s' % typ)
-            elif self._status == STATUS['data']:
-                if len(data) < 5:
-                    return
-                size, typ = struct.unpack('<lb', data[:5])
-                if size > (len(data) - 4):    # wait for more packet data
-                    return
-                data_size = size - 1
-                if typ == 0x03:   # data
-                    self._recv_file_size += data_size
-                    self._total_recv_size += data_size
-                    agent.recv_feed_file(
-                        self._filename, data[5:5 + data_size],
-                        self._recv_file_size, self._filesize,
-                        self._total_recv_size, self._total_size,
-                        from_addr,
-                    )
-                    del data[:5 + data_size]
-                    if self._recv_file_size == self._filesize:
-                        self._status = STATUS['header']
-                        self._recv_record += 1
-                        agent.recv_finish_file(self._filename, from_addr)
-                    if self._record == self._recv_record and  \
-                            self._total_recv_size == self._total_size:
-                        self._status = STATUS['idle']
-                        return True
-                else:
-                    raise ValueError('Error Type: %s' % typ)
+
+    def in_file(self):
+        """True if data of current file is not received completely"""
+        return self._status == STATUS['data']
+
+    def unpack_data(self, agent, data, from_addr):
+        """walk all complete data packets of current file in one pass.
+
+        Payload is passed to agent as a list of memoryview by one call,
+        it is only valid in "recv_feed_file".
+        """
+        chunks = []
+        batch_size = 0
+        left_size = self._filesize - self._recv_file_size
+        while batch_size < left_size and len(data) >= FRAME_HEADER.size:
+            size, typ = data.peek(FRAME_HEADER)
+            if typ != 0x03 or size > (len(data) - 4):
+                break
+            data.consume(FRAME_HEADER.size)
+            chunk = data.read(size - 1)
+            chunks.append(chunk)
+            batch_size += len(chunk)
+
+        self._recv_file_size += batch_size
+        self._total_recv_size += batch_size
+        agent.recv_feed_file(
+            self._filename, chunks,
+            self._recv_file_size, self._filesize,
+            self._total_recv_size, self._total_size,
+            from_addr,
+        )
+        for chunk in chunks:
+            chunk.release()
+        if self._recv_file_size == self._filesize:
+            self._status = STATUS['header']
+            self._recv_record += 1
+            agent.recv_finish_file(self._filename, from_addr)
+        if self._record == self._recv_record and  \
+                self._total_recv_size == self._total_size:
+            self._status = STATUS['idle']
+            return True
 
 
 class UDPHandler(socketserver.BaseRequestHandler):
@@ -271,28 +294,40 @@ class UDPHandler(socketserver.BaseRequestHandler):
         self._packet = Packet()
 
     def handle(self):
-        if self.client_address[0] not in self.server.agent._ip_addrs:
+        if self.request[0] == FEATURE_QUERY:
+            self.server.agent.say_features(self.client_address)
+        elif self.client_address[0] not in self.server.agent._ip_addrs:
             data = bytearray(self.request[0])
             self._packet.unpack_udp(self.server.agent, data, self.client_address)
 
 
 class TCPHandler(socketserver.BaseRequestHandler):
     def setup(self):
-        self._recv_buff = bytearray()
+        self._recv_buff = BUFFER_POOL.get()
         self._packet = Packet()
         self.request.settimeout(20)
+        self._tuner = self.server.agent.create_tuner(self.server.agent._recv_size)
+        self._err = 'abort'   # handle() may be broken by exception
 
     def handle(self):
         logger.info('[NitroShare] connect from %s:%s' % self.client_address)
         err = ''
         ret = None
+        # stream of ndrop sender may be compressed or control request
+        unwrapped = False
         while True:
             try:
-                data = self.request.recv(CHUNK_SIZE)
-                if not data:
+                num = self._recv_buff.recv_into(self.request, self._tuner.size)
+                if not num:
                     err = 'abort'
                     break
-                self._recv_buff.extend(data)
+                self._tuner.update(num)
+                if not unwrapped:
+                    packet = unwrap_packet(self._packet, self._recv_buff, self.request)
+                    if packet is None:
+                        continue
+                    unwrapped = True
+                    self._packet = packet
                 ret = self._packet.unpack_tcp(self.server.agent, self._recv_buff, self.client_address)
             except Exception as e:
                 err = e
@@ -303,18 +338,27 @@ class TCPHandler(socketserver.BaseRequestHandler):
                 self.request.sendall(data)
                 err = 'done'
                 break
-        if err == 'abort':
-            self.server.agent.recv_finish_file(self._packet._filename, self.client_address)
-        self.server.agent.recv_finish(self.client_address, err)
+        self._err = err
 
     def finish(self):
-        pass
+        """called on every exit of handle()"""
+        try:
+            if isinstance(self._packet, CompressedPacket):
+                # wait for file data in thread
+                self._packet.close()
+            if self._err != 'done' and self._packet.in_file():
+                # reset, timeout or error, truncate and journal part file
+                self.server.agent.recv_finish_file(self._packet._filename, self.client_address)
+        finally:
+            self.server.agent.recv_finish(self.client_address, self._err)
+            BUFFER_POOL.put(self._recv_buff)
 
 
 class NitroshareServer(Transport):
     _name = 'NitroShare'
     _cert = None
     _key = None
+    _ssl_context = None
     _upper_level = None
     _tcp_server = None
     _udp_server = None
@@ -333,7 +377,7 @@ class NitroshareServer(Transport):
     def __repr__(self):
         return '<NitroshareServer>'
 
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    def __init__(self, upper_level, addr, ssl_ck=None, max_workers=None, io_size=None):
         if ssl_ck:
             self._cert, self._key = ssl_ck
         self._upper_level = upper_level
@@ -352,20 +396,33 @@ class NitroshareServer(Transport):
         data['operating_system'] = get_platform_system()
         data['port'] = '%s' % self._tcp_port
         data['uses_tls'] = bool(self._cert) and bool(self._key)
+        # stock NitroShare ignore it
+        data['ndrop'] = FEATURES
         self._node = data
 
         self._nodes = {}
         self._udp_server = socketserver.UDPServer((ip, self._udp_port), UDPHandler)
         self._udp_server.agent = self
 
-        self._tcp_server = socketserver.TCPServer((ip, self._tcp_port), TCPHandler)
         if self._cert and self._key:
             self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
             self._ssl_context.load_cert_chain(self._cert, keyfile=self._key)
-            self._tcp_server.socket = self._ssl_context.wrap_socket(
-                self._tcp_server.socket, server_side=True)
+            # sender never read, unread session ticket will reset connection when close
+            self._ssl_context.num_tickets = 0
+        # every connection is handled in worker pool, with TLS if need
+        self._tcp_server = ThreadPoolTCPServer(
+            (ip, self._tcp_port), TCPHandler,
+            max_workers=max_workers, ssl_context=self._ssl_context, bind_and_activate=False)
         self._tcp_server.agent = self
-        set_chunk_size()
+        self.set_io_size(**(io_size or {}))
+        # buffer size is used for TCP window scale only if it is set before listen
+        self.setup_socket(self._tcp_server.socket)
+        try:
+            self._tcp_server.server_bind()
+            self._tcp_server.server_activate()
+        except OSError:
+            self._tcp_server.server_close()
+            raise
 
         self._unicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -383,7 +440,9 @@ class NitroshareServer(Transport):
             target=self.loop_say_hello,
             daemon=True,
         ).start()
+        self.show_listen()
 
+    def show_listen(self):
         if self._tcp_server.server_address[0] == '0.0.0.0':
             logger.info('[NitroShare] listen on %s:%s(tcp):%s(udp) - bind on %s' % (
                 self._tcp_server.server_address[0], self._tcp_server.server_address[1],
@@ -417,6 +476,12 @@ class NitroshareServer(Transport):
     def recv_finish_file(self, path, from_addr):
         self._upper_level.recv_finish_file(path, from_addr)
 
+    def recv_control(self, message, from_addr):
+        return self._upper_level.recv_control(message, from_addr)
+
+    def recv_control_replied(self, from_addr):
+        self._upper_level.recv_control_replied(from_addr)
+
     def recv_finish(self, from_addr, err):
         """当前任务全部完成"""
         self._upper_level.recv_finish(from_addr, err)
@@ -442,10 +507,17 @@ class NitroshareServer(Transport):
             except Exception as err:
                 logger.error('[NitroShare]send to "%s" error: %s' % (dest, err))
 
+    def say_features(self, dest):
+        """ndrop extensions are in every hello"""
+        self.say_hello(dest)
+
+    def hello(self):
+        self.say_hello(('<broadcast>', self._udp_port))
+        self.check_node()
+
     def loop_say_hello(self):
         while self._loop_hello:
-            self.say_hello(('<broadcast>', self._udp_port))
-            self.check_node()
+            self.hello()
             time.sleep(self._hello_interval)
 
     def add_node(self, ip, node):
@@ -496,9 +568,11 @@ class NitroshareClient(Transport):
     _key = None
     _upper_level = None
     _packet = None
+    _sock = None
+    _writer = None
     _timeout = 5
 
-    def __init__(self, upper_level, addr, ssl_ck=None):
+    def __init__(self, upper_level, addr, ssl_ck=None, io_size=None):
         if ssl_ck:
             self._cert, self._key = ssl_ck
         self._upper_level = upper_level
@@ -508,12 +582,18 @@ class NitroshareClient(Transport):
             tcp_port = int(addr.pop(0))
         else:
             tcp_port = DEFAULT_TCP_PORT
+        if len(addr) > 0:
+            udp_port = int(addr.pop(0))
+        else:
+            udp_port = DEFAULT_UDP_PORT
         self._address = (ip, tcp_port)
+        self._udp_address = (ip, udp_port)
         self._packet = Packet()
-        set_chunk_size()
+        self.set_io_size(**(io_size or {}))
 
     def send_files(self, total_size, files):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setup_socket(sock)
         if self._cert and self._key:
             ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
             ssl_context.check_hostname = False
@@ -524,18 +604,23 @@ class NitroshareClient(Transport):
         err = 'done'
         try:
             header = self._packet.pack_files_header(get_platform_name(), total_size, len(files))
+            compress = self._compress and COMPRESS_FEATURE in self.query_features(self._udp_address)
             sock.connect(self._address)
-            sock.sendall(header)
-
-            for chunk in self._packet.pack_files(self, total_size, files):
-                sock.sendall(chunk)
+            if compress:
+                self.send_compressed(sock, header, total_size, files)
+            elif isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg') or self._offsets:
+                sock.sendall(header)
+                tuner = self.create_tuner(self._read_size)
+                for chunk in self._packet.pack_files(self, total_size, files, self._offsets):
+                    sock.sendall(chunk)
+                    self._read_size = tuner.update(len(chunk))
+            else:
+                sock.sendall(header)
+                self.sendmsg_files(sock, total_size, files)
             # receive feedback message
-            data = bytearray()
-            while True:
-                chunk = sock.recv(CHUNK_SIZE)
-                if not chunk:
-                    break
-                data.extend(chunk)
+            data = RecvBuffer()
+            while data.recv_into(sock):
+                pass
             self._packet.unpack_tcp(self, data, self._address)
         except KeyboardInterrupt:
             pass
@@ -548,9 +633,160 @@ class NitroshareClient(Transport):
         sock.close()
         self.send_finish(err)
 
+    def send_compressed(self, sock, header, total_size, files):
+        """send stream in compressed frames, peer is ndrop"""
+        self._writer = CompressWriter(sock)
+        try:
+            self._writer.sendall(header)
+            for chunk in self._packet.pack_files(self, total_size, files, self._offsets):
+                self._writer.sendall(chunk)
+            self._writer.flush()
+        finally:
+            self._writer.close()
+            self._writer = None
+
+    def send_stream(self, total_size, count, items):
+        """send file data prepared by caller.
+
+        "items" yield (name, size, chunk), chunk is None at start of file.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setup_socket(sock)
+        if self._cert and self._key:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            sock = ssl_context.wrap_socket(sock, server_side=False)
+        sock.settimeout(self._timeout)
+        self._sock = sock
+        try:
+            sock.connect(self._address)
+            data = self._packet.pack_files_header(get_platform_name(), total_size, count)
+            for name, size, chunk in items:
+                if chunk is None:
+                    data.extend(self._packet.pack_file_header(name, size))
+                    continue
+                data.extend(self._packet.pack_data_header(len(chunk)))
+                if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg'):
+                    data.extend(chunk)
+                    sock.sendall(data)
+                else:
+                    sendmsg_all(sock, [data, chunk])
+                data.clear()
+            if data:
+                sock.sendall(data)
+            # receive feedback message
+            data = RecvBuffer()
+            while data.recv_into(sock):
+                pass
+            self._packet.unpack_tcp(self, data, self._address)
+        finally:
+            sock.close()
+            self._sock = None
+
+    def abort(self):
+        """stop "send_stream" from other thread"""
+        sock = self._sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def sendmsg_files(self, sock, total_size, files):
+        """send frame headers and file data with sendmsg.
+
+        File data is read into a send buffer with "readinto", every frame
+        is a memoryview of it, so file data is not copied in user space.
+        """
+        buff = memoryview(bytearray(self._read_size * SENDMSG_FRAMES))
+        pos = 0
+        iov = []
+        batch = []
+        pending = 0
+        total_send_size = 0
+        tuner = self.create_tuner(self._read_size)
+        for path, name, size, chunk in prefetch_files(files, SMALL_FILE_SIZE):
+            iov.append(self._packet.pack_file_header(name, size))
+            send_size = 0
+            if size < 0:    # directory
+                batch.append((name, None, -1))
+            elif size == 0:
+                batch.append((name, b'', 0))
+            elif chunk is not None:     # small file, one frame
+                if len(chunk) != size:
+                    chunk = b''.join(fit_chunks(self.file_changed, path, name, size, [chunk]))
+                total_send_size += size
+                pending += size
+                batch.append((name, chunk, size))
+                iov.append(self._packet.pack_data_header(size))
+                iov.append(chunk)
+            else:
+                self.flush_files(sock, iov, batch, total_send_size, total_size)
+                pos = pending = 0
+                with open(path, 'rb') as f:
+                    advise_file(f.fileno(), 0, 0, 'SEQUENTIAL')
+                    advise_file(f.fileno(), 0, len(buff) * 2, 'WILLNEED')
+                    end = size
+                    file_size = os.fstat(f.fileno()).st_size
+                    if file_size != size and self.file_changed(name, size, file_size) == 'skip':
+                        end = 0
+                    while send_size < end:
+                        chunk_size = min(self._read_size, end - send_size)
+                        if pos + chunk_size > len(buff) or len(iov) >= IOV_MAX - 2:
+                            self._read_size = tuner.update(
+                                self.flush_files(sock, iov, batch, total_send_size, total_size))
+                            pos = 0
+                            if len(buff) < self._read_size * SENDMSG_FRAMES:
+                                buff = memoryview(bytearray(self._read_size * SENDMSG_FRAMES))
+                            chunk_size = min(self._read_size, end - send_size)
+                            # read next buffer when send this one
+                            advise_file(f.fileno(), send_size + len(buff), len(buff), 'WILLNEED')
+                        chunk = buff[pos:pos + f.readinto(buff[pos:pos + chunk_size])]
+                        if not chunk:   # file is truncated
+                            if file_size == size:
+                                self.file_changed(name, size, send_size)
+                            break
+                        pos += len(chunk)
+                        send_size += len(chunk)
+                        total_send_size += len(chunk)
+                        self.send_feed_file(name, chunk, send_size, size, total_send_size, total_size)
+                        iov.append(self._packet.pack_data_header(len(chunk)))
+                        iov.append(chunk)
+                    if send_size == size and file_size == size and f.read(1):
+                        self.file_changed(name, size, os.fstat(f.fileno()).st_size)
+                    # fill zeros to keep size of file header
+                    for chunk in zero_chunks(size - send_size):
+                        send_size += len(chunk)
+                        total_send_size += len(chunk)
+                        self.send_feed_file(name, chunk, send_size, size, total_send_size, total_size)
+                        iov.append(self._packet.pack_data_header(len(chunk)))
+                        iov.append(chunk)
+                        if len(iov) >= IOV_MAX - 2:
+                            self.flush_files(sock, iov, batch, total_send_size, total_size)
+                self.send_finish_file(name)
+            if pending >= SEND_BUFFER_SIZE or len(iov) >= IOV_MAX - 2:
+                self.flush_files(sock, iov, batch, total_send_size, total_size)
+                pos = pending = 0
+        self.flush_files(sock, iov, batch, total_send_size, total_size)
+
+    def flush_files(self, sock, iov, batch, total_send_size, total_size):
+        """send buffers in "iov", then report small files in "batch"."""
+        sent = sendmsg_all(sock, iov)
+        iov.clear()
+        if batch:
+            self.send_feed_files(batch, total_send_size, total_size)
+            batch.clear()
+        return sent
+
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        if self._writer:
+            self._writer.feed_file(data, send_size)
         self._upper_level.send_feed_file(path, data, send_size, file_size, total_send_size, total_size)
 
+    def send_feed_files(self, files, total_send_size, total_size):
+        self._upper_level.send_feed_files(files, total_send_size, total_size)
+
     def send_finish_file(self, path):
         self._upper_level.send_finish_file(path)
 
@@ -1,10 +1,23 @@
 
+import os
+import errno
 import logging
 import socket
+import socketserver
+import ssl
+import struct
+import json
+import select
 import ipaddress
 import math
+import mmap
 import platform
+import queue
+import threading
+import time
 from os import environ
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import ifaddr
 
@@ -12,18 +25,81 @@ logger = logging.getLogger(__name__)
 
 
 CHUNK_SIZE = 1024 * 64
+MAX_WORKERS = 32
+# mmap window to write file directly, multiple of mmap.ALLOCATIONGRANULARITY
+DIRECT_WINDOW = 1024 * 1024 * 4
+PIPE_SIZE = 1024 * 1024
+# pack small files into send buffer up to it
+SEND_BUFFER_SIZE = 1024 * 1024
+# read small files ahead when send
+PREFETCH_WORKERS = 4
+PREFETCH_BATCH = 64
+# buffers of read-ahead ring
+READ_AHEAD_DEPTH = 4
+READ_AHEAD_SIZE = 1024 * 1024
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+# ndrop extensions, peer is asked by UDP before send. Stock peers ignore it
+FEATURES = ['zlib', 'resume', 'dedup', 'checksum']
+FEATURE_QUERY = b'NDROP?'
+FEATURE_TIMEOUT = 1
+# first bytes of control connection. ndrop sender asks ndrop receiver
+# before transfer, one JSON message is replied
+CONTROL_MAGIC = b'NDROPC\x00\x01'
+# receiver may read files before reply, e.g. hash data of resumed files,
+# so timeout of control request is longer and grows with data to read
+CONTROL_TIMEOUT = 60
+CONTROL_RATE = 1024 * 1024 * 20
+# size of JSON message
+MESSAGE_SIZE = struct.Struct('<L')
 
 
-def set_chunk_size(size=None):
-    global CHUNK_SIZE
+def parse_size(value):
+    """size with unit: 65536, 64K, 4M"""
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sndbuf = s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
-    CHUNK_SIZE = min(sndbuf, CHUNK_SIZE)
 
-    if size:
-        CHUNK_SIZE = min(size, sndbuf)
-    logger.debug('CHUNK_SIZE: %s' % CHUNK_SIZE)
+class AutoTuner(object):
+    """grow I/O size while throughput improves, then keep the best one"""
+    interval = 0.5
+    max_size = 1024 * 1024 * 4
+
+    def __init__(self, size, enable=True):
+        self.size = size
+        self._enable = enable
+        self._best_rate = 0
+        self._best_size = size
+        self._bytes = 0
+        self._start = time.monotonic()
+
+    def update(self, nbytes):
+        if not self._enable:
+            return self.size
+        self._bytes += nbytes
+        elapsed = time.monotonic() - self._start
+        if elapsed < self.interval:
+            return self.size
+        rate = self._bytes / elapsed
+        if rate > self._best_rate * 1.05:
+            self._best_rate = rate
+            self._best_size = self.size
+            if self.size < self.max_size:
+                self.size = min(self.size * 2, self.max_size)
+            else:
+                self._enable = False
+        else:   # no better, go back and stop
+            self.size = self._best_size
+            self._enable = False
+        logger.debug('I/O size: %s, %s/s' % (human_size(self.size), human_size(rate)))
+        self._bytes = 0
+        self._start = time.monotonic()
+        return self.size
 
 
 def human_size(size):
@@ -81,8 +157,546 @@ def get_platform_name():
     return node
 
 
+def read_small_files(files):
+    """read content of (path, size) list"""
+    contents = []
+    for path, size in files:
+        with open(path, 'rb') as f:
+            # one more byte to find file grown
+            contents.append(f.read(size + 1))
+    return contents
+
+
+def prefetch_files(files, max_size, workers=None):
+    """read small files ahead in thread pool.
+
+    yield (path, name, size, data), "data" is file content if "size" is
+    less than "max_size", else None. Small files are read in batch of
+    PREFETCH_BATCH files.
+    """
+    window = deque()
+    items = []
+    small_files = []
+    with ThreadPoolExecutor(max_workers=workers or PREFETCH_WORKERS) as executor:
+        for path, name, size in files:
+            items.append((path, name, size))
+            if 0 < size < max_size:
+                small_files.append((path, size))
+            if len(items) < PREFETCH_BATCH:
+                continue
+            window.append((items, executor.submit(read_small_files, small_files)))
+            items = []
+            small_files = []
+            if len(window) < (workers or PREFETCH_WORKERS) * 2:
+                continue
+            yield from _prefetched(*window.popleft(), max_size)
+        window.append((items, executor.submit(read_small_files, small_files)))
+        while window:
+            yield from _prefetched(*window.popleft(), max_size)
+
+
+def _prefetched(items, future, max_size):
+    contents = iter(future.result())
+    for path, name, size in items:
+        if 0 < size < max_size:
+            yield path, name, size, next(contents)
+        else:
+            yield path, name, size, None
+
+
+# policy of file changed when send
+CHANGE_POLICIES = ['truncate', 'skip', 'abort', 'snapshot']
+
+
+class FileChangedError(ValueError):
+    pass
+
+
+def file_changed(policy, name, size, new_size):
+    """return "truncate" or "skip", raise FileChangedError if "abort".
+
+    truncate: send file with old size, drop more data or fill zeros.
+    skip: don't read file changed before it is opened, send zeros. If it
+    is changed when it is read, same as truncate.
+    """
+    message = 'File Changed: [%s] %s => %s.' % (name, size, new_size)
+    if policy == 'abort':
+        raise FileChangedError(message)
+    if policy == 'skip':
+        logger.error('%s Skip.' % message)
+        return 'skip'
+    logger.error('%s Truncate.' % message)
+    return 'truncate'
+
+
+def zero_chunks(size):
+    """yield zeros of "size" bytes"""
+    zeros = memoryview(bytes(min(size, CHUNK_SIZE)))
+    while size > 0:
+        yield zeros[:size]
+        size -= len(zeros)
+
+
+def read_chunks(path, size, chunk_size):
+    """yield file data, one more byte is read to find file grown"""
+    with open(path, 'rb') as f:
+        size += 1
+        while size > 0:
+            chunk = f.read(min(chunk_size, size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+
+
+def fit_chunks(changed, path, name, size, chunks, offset=0):
+    """yield "size" bytes from "chunks" even if file is changed.
+
+    "changed" is called with (name, size, new_size) and return action.
+    Same as sendfile and sendmsg path, file changed before it is read is
+    sent as zeros if action is "skip". "size" is from "offset" of resumed
+    file.
+    """
+    file_size = offset + size
+    try:
+        new_size = os.path.getsize(path)
+    except OSError:
+        new_size = 0
+    reported = new_size != file_size
+    if reported and changed(name, file_size, new_size) == 'skip':
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        yield from zero_chunks(size)
+        return
+    send_size = 0
+    for chunk in chunks:
+        if send_size + len(chunk) > size:
+            if not reported:
+                changed(name, file_size, os.path.getsize(path))
+            chunk = chunk[:size - send_size]
+            if chunk:
+                send_size += len(chunk)
+                yield chunk
+            break
+        send_size += len(chunk)
+        yield chunk
+    if send_size < size:
+        if not reported:
+            changed(name, file_size, offset + send_size)
+        yield from zero_chunks(size - send_size)
+
+
+def pack_message(message):
+    data = json.dumps(message).encode('utf-8')
+    return MESSAGE_SIZE.pack(len(data)) + data
+
+
+def unpack_message(data):
+    """message in RecvBuffer "data", None if it is not complete"""
+    if len(data) < MESSAGE_SIZE.size:
+        return None
+    size, = data.peek(MESSAGE_SIZE)
+    if len(data) < MESSAGE_SIZE.size + size:
+        return None
+    data.consume(MESSAGE_SIZE.size)
+    return json.loads(bytes(data.read(size)).decode('utf-8'))
+
+
+def preallocate_file(fileno, size):
+    """posix_fallocate, file gets contiguous extents and disk full is known early"""
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fileno, 0, size)
+        except OSError as err:
+            if err.errno == errno.ENOSPC:
+                raise
+            # not supported by file system
+
+
+def advise_file(fileno, offset, size, advice):
+    """posix_fadvise, "advice" is SEQUENTIAL, WILLNEED..."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fileno, offset, size, getattr(os, 'POSIX_FADV_' + advice))
+        except OSError:
+            pass
+
+
+class ReadAhead(object):
+    """read file data in thread ahead of socket.
+
+    Chunks are read into a ring of "depth" buffers. A chunk is valid until
+    next chunk is taken. One more byte is read after file size to find
+    file grown. File less than "chunk_size" is read when it is taken.
+    """
+    def __init__(self, files, chunk_size=None, depth=None, offsets=None):
+        chunk_size = chunk_size or READ_AHEAD_SIZE
+        # file is read from offset if it is resumed
+        self._offsets = offsets or {}
+        self._free = queue.Queue()
+        for x in range(depth or READ_AHEAD_DEPTH):
+            self._free.put(bytearray(chunk_size))
+        self._full = queue.Queue()
+        self._last = None
+        self._chunk_size = chunk_size
+        self._thread = threading.Thread(target=self.run, args=(files,), daemon=True)
+        self._thread.start()
+
+    def run(self, files):
+        try:
+            large_files = (
+                (path, self._offsets.get(name, 0), size - self._offsets.get(name, 0))
+                for path, name, size in files
+                if size - self._offsets.get(name, 0) >= self._chunk_size
+            )
+            current = next(large_files, None)
+            while current:
+                path, offset, size = current
+                current = next(large_files, None)
+                if current:     # start to read next file
+                    with open(current[0], 'rb') as f:
+                        advise_file(f.fileno(), current[1], self._chunk_size * 2, 'WILLNEED')
+                with open(path, 'rb') as f:
+                    advise_file(f.fileno(), 0, 0, 'SEQUENTIAL')
+                    f.seek(offset)
+                    if not self.read_file(path, f, size + 1):
+                        return
+                self._full.put((path, None, 0))
+        except Exception as err:
+            self._full.put((None, None, err))
+
+    def read_file(self, path, f, size):
+        """return False if closed"""
+        while size > 0:
+            buff = self._free.get()
+            if buff is None:
+                return False
+            num = f.readinto(memoryview(buff)[:size])
+            if not num:
+                self._free.put(buff)
+                break
+            size -= num
+            self._full.put((path, buff, num))
+        return True
+
+    def chunks(self, path, size, offset=0):
+        """yield chunks of file "path" in order of files, "size" is from "offset" """
+        if size < self._chunk_size:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                yield f.read(size + 1)
+            return
+        while True:
+            if self._last is not None:
+                self._free.put(self._last)
+                self._last = None
+            tag, buff, num = self._full.get()
+            if tag is None:
+                raise num
+            if tag != path:     # rest of dropped file
+                if buff is not None:
+                    self._free.put(buff)
+                continue
+            if buff is None:
+                return
+            self._last = buff
+            yield memoryview(buff)[:num]
+
+    def close(self):
+        self._free.put(None)
+
+
+def sendmsg_all(sock, buffers):
+    """sendall for scatter-gather buffers, return sent size"""
+    views = [memoryview(buff) for buff in buffers]
+    total = 0
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        total += sent
+        while sent > 0:
+            if sent >= len(views[index]):
+                sent -= len(views[index])
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+        # skip empty buffer
+        while index < len(views) and not views[index]:
+            index += 1
+    return total
+
+
+def splice_from_socket(sock, fileno, offset, size, pipe):
+    """move at most "size" bytes from socket to file at "offset" by splice(2).
+
+    Return moved size, 0 if connection is closed.
+    """
+    total = 0
+    while total < size:
+        try:
+            num = os.splice(sock.fileno(), pipe[1], size - total)
+        except BlockingIOError:  # socket with timeout is non-blocking
+            if total > 0:
+                break
+            r, w, e = select.select([sock], [], [], sock.gettimeout())
+            if not r:
+                raise socket.timeout('timed out')
+            continue
+        if num == 0:
+            break
+        while num > 0:
+            moved = os.splice(pipe[0], fileno, num, offset_dst=offset + total)
+            num -= moved
+            total += moved
+    return total
+
+
+def _splice_into_file(sock, fileno, offset, end):
+    pipe = os.pipe()
+    try:
+        try:
+            import fcntl
+            fcntl.fcntl(pipe[1], fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except (ImportError, AttributeError, OSError):
+            pass
+        while offset < end:
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            stop = min(start + DIRECT_WINDOW, end)
+            num = splice_from_socket(sock, fileno, offset, stop - offset, pipe)
+            if num == 0:
+                return
+            # read back from page cache for digest
+            with mmap.mmap(fileno, offset + num - start, access=mmap.ACCESS_READ, offset=start) as mm:
+                chunk = memoryview(mm)[offset - start:]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+            offset += num
+    finally:
+        os.close(pipe[0])
+        os.close(pipe[1])
+
+
+def _mmap_into_file(sock, fileno, offset, end):
+    os.ftruncate(fileno, end)
+    try:
+        while offset < end:
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            stop = min(start + DIRECT_WINDOW, end)
+            with mmap.mmap(fileno, stop - start, access=mmap.ACCESS_WRITE, offset=start) as mm:
+                view = memoryview(mm)
+                pos = offset - start
+                while pos < stop - start:
+                    num = sock.recv_into(view[pos:])
+                    if num == 0:
+                        break
+                    pos += num
+                chunk = view[offset - start:pos]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+                    view.release()
+            if start + pos == offset:   # connection is closed
+                return
+            offset = start + pos
+    finally:
+        if offset < end:
+            os.ftruncate(fileno, offset)
+
+
+def recv_into_file(sock, fileno, offset, size):
+    """receive "size" bytes from socket into file at "offset", no copy in Python.
+
+    Linux moves data by splice(2), others receive into mmap of file. Yield
+    memoryview of every window written, it is valid until next iteration.
+    Stop if connection is closed.
+    """
+    if hasattr(os, 'splice'):
+        return _splice_into_file(sock, fileno, offset, offset + size)
+    return _mmap_into_file(sock, fileno, offset, offset + size)
+
+
+class RecvBuffer(object):
+    """receive buffer read by cursor.
+
+    Data between "start" and "end" is unread. Packet parser reads it by
+    offset and get memoryview, no copy. Unread data is moved to front only
+    when there is no room at the end.
+    """
+    def __init__(self, size=None):
+        self._buff = bytearray(size or CHUNK_SIZE * 4)
+        self._view = memoryview(self._buff)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def extend(self, data):
+        size = len(data)
+        if self.end + size > len(self._buff):
+            self.compact(size)
+        self._view[self.end:self.end + size] = data
+        self.end += size
+
+    def compact(self, size=0):
+        """move unread data to front, grow buffer if no room for "size" """
+        length = self.end - self.start
+        if length + size > len(self._buff):
+            buff = bytearray(max(length + size, len(self._buff) * 2))
+            buff[:length] = self._view[self.start:self.end]
+            self._view.release()
+            self._buff = buff
+            self._view = memoryview(buff)
+        elif length > 0:
+            self._view[:length] = self._view[self.start:self.end]
+        self.start = 0
+        self.end = length
+
+    def clear(self):
+        self.start = self.end = 0
+
+    def room(self, size=None):
+        """memoryview of free room at the end, at least "size" bytes"""
+        size = size or CHUNK_SIZE
+        if len(self._buff) - self.end < size:
+            self.compact(size)
+        return self._view[self.end:]
+
+    def advance(self, size):
+        """"size" bytes are written into room"""
+        self.end += size
+
+    def recv_into(self, sock, size=None):
+        """receive from socket into room directly"""
+        num = sock.recv_into(self.room(size))
+        self.end += num
+        return num
+
+    def consume(self, size):
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def find(self, sub):
+        pos = self._buff.find(sub, self.start, self.end)
+        if pos < 0:
+            return pos
+        return pos - self.start
+
+    def read(self, size):
+        """memoryview of unread data, valid until next "extend" """
+        view = self._view[self.start:min(self.start + size, self.end)]
+        self.consume(len(view))
+        return view
+
+    def peek(self, fmt):
+        """unpack by struct.Struct, keep cursor"""
+        return fmt.unpack_from(self._buff, self.start)
+
+    def unpack(self, fmt):
+        """unpack by struct.Struct without copy"""
+        value = fmt.unpack_from(self._buff, self.start)
+        self.consume(fmt.size)
+        return value
+
+
+class BufferPool(object):
+    """RecvBuffer reused by all connections"""
+    def __init__(self, count=None, size=None):
+        self._count = count or MAX_WORKERS
+        self._size = size
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return RecvBuffer(self._size)
+
+    def put(self, buff):
+        buff.clear()
+        with self._lock:
+            if len(self._free) < self._count:
+                self._free.append(buff)
+
+
+BUFFER_POOL = BufferPool()
+
+
+class ThreadPoolTCPServer(socketserver.TCPServer):
+    """TCPServer handling every connection in a bounded worker pool.
+
+    TLS handshake is done in the worker, a slow peer never blocks accept.
+    """
+    request_timeout = 20
+
+    def __init__(self, server_address, RequestHandlerClass, max_workers=None, ssl_context=None,
+                 bind_and_activate=True):
+        self.ssl_context = ssl_context
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or MAX_WORKERS,
+            thread_name_prefix='%s worker' % RequestHandlerClass.__module__,
+        )
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            request.settimeout(self.request_timeout)
+            if self.ssl_context:
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
 class Transport(object):
     _timeout = 5
+    # file read size and packet size when send
+    _read_size = CHUNK_SIZE
+    # socket receive size
+    _recv_size = CHUNK_SIZE * 4
+    # SO_SNDBUF and SO_RCVBUF, None is system default
+    _sock_buf_size = None
+    _auto_tune = False
+    _change_policy = 'truncate'
+    # use ndrop extensions if peer support them
+    _compress = False
+    # offset of resumed files, key is file name
+    _offsets = None
+    # ndrop extensions of peer
+    _features = None
+
+    def set_io_size(self, read_size=None, recv_size=None, sock_buf_size=None, auto_tune=None):
+        if read_size:
+            self._read_size = read_size
+        if recv_size:
+            self._recv_size = recv_size
+        if sock_buf_size:
+            self._sock_buf_size = sock_buf_size
+        if auto_tune is not None:
+            self._auto_tune = auto_tune
+
+    def setup_socket(self, sock):
+        if self._sock_buf_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sock_buf_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._sock_buf_size)
+
+    def create_tuner(self, size):
+        return AutoTuner(size, enable=self._auto_tune)
 
     def send_text(self, text):
         pass
@@ -90,9 +704,74 @@ class Transport(object):
     def send_files(self, total_size, files):
         pass
 
+    def set_change_policy(self, policy):
+        if policy:
+            self._change_policy = policy
+
+    def file_changed(self, name, size, new_size):
+        return file_changed(self._change_policy, name, size, new_size)
+
+    def set_compress(self, compress):
+        self._compress = compress
+
+    def set_offsets(self, offsets):
+        self._offsets = offsets
+
+    def connect(self):
+        """socket connected to peer, with TLS if cert is given"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self._cert and self._key:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            sock = ssl_context.wrap_socket(sock, server_side=False)
+        sock.settimeout(self._timeout)
+        sock.connect(self._address)
+        return sock
+
+    def request(self, message, size=0):
+        """request ndrop receiver on control connection, return reply.
+
+        Receiver may read "size" bytes of files before it replies.
+        """
+        sock = self.connect()
+        try:
+            sock.settimeout(CONTROL_TIMEOUT + size / CONTROL_RATE)
+            sock.sendall(CONTROL_MAGIC + pack_message(message))
+            data = RecvBuffer()
+            while True:
+                reply = unpack_message(data)
+                if reply is not None:
+                    return reply
+                if not data.recv_into(sock):
+                    raise ConnectionError('Connection closed by peer')
+        finally:
+            sock.close()
+
+    def query_features(self, address):
+        """ask ndrop extensions of peer at UDP "address", return [] if peer is not ndrop"""
+        if self._features is not None:
+            return self._features
+        self._features = []
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(FEATURE_TIMEOUT)
+        try:
+            sock.sendto(FEATURE_QUERY, address)
+            data, _ = sock.recvfrom(65536)
+            self._features = self._packet.unpack_features(bytearray(data))
+        except (OSError, ValueError) as err:
+            logger.info('No ndrop extension on %s:%s: %s' % (*address, err))
+        finally:
+            sock.close()
+        return self._features
+
     def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
         pass
 
+    def send_feed_files(self, files, total_send_size, total_size):
+        """small files and directories are sent, "files" is list of (path, data, file_size)"""
+        pass
+
     def send_finish_file(self, path):
         pass
 
@@ -107,3 +786,9 @@ class Transport(object):
 
     def recv_finish_file(self, path, from_addr):
         pass
+
+    def recv_control(self, message, from_addr):
+        return {'error': 'Not supported'}
+
+    def recv_control_replied(self, from_addr):
+        pass
@@ -0,0 +1,154 @@
+import os
+import re
+import sys
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from .digest import ALGORITHMS, SUM_FILES, hash_file
+
+
+logger = logging.getLogger(__name__)
+
+
+# hashes of digest by its length, if header and name of checksum file are unknown
+DIGEST_SIZES = {32: ['md5'], 64: ['sha256', 'tree'], 128: ['blake2b']}
+VERIFY_WORKERS = os.cpu_count() or 4
+# files read at once on rotational disk, seek is slow
+ROTATIONAL_DEPTH = 1
+
+
+def io_depth(path):
+    """files to read at once on storage of "path", by queue of block device"""
+    try:
+        st = os.stat(path)
+        queue = '/sys/dev/block/%s:%s/queue' % (os.major(st.st_dev), os.minor(st.st_dev))
+        if not os.path.exists(queue):   # partition
+            queue = os.path.join(os.path.dirname(queue), '..', 'queue')
+        with open(os.path.join(queue, 'rotational')) as f:
+            if f.read().strip() == '1':
+                return ROTATIONAL_DEPTH
+    except (OSError, ValueError, AttributeError):
+        pass
+    return VERIFY_WORKERS
+
+
+def unescape(name):
+    """name of escaped line in md5sum format"""
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+
+
+def read_sums(f):
+    """read (digest, name) from lines of md5sum, b2sum, sha256sum format"""
+    for line in f:
+        line = line.rstrip('\n')
+        if not line or line.startswith('#'):
+            continue
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        digest, _, name = line.partition(' ')
+        # " name" is text mode, "*name" is binary mode
+        if name[:1] not in (' ', '*') or len(name) < 2:
+            logger.warning('Invalid line: %s' % line)
+            continue
+        name = name[1:]
+        yield digest.lower(), unescape(name) if escaped else name
+
+
+def read_header(f):
+    """hash in "# hash: <hash>" line at head of checksum file, None if no header"""
+    for line in f:
+        if not line.startswith('#'):
+            break
+        match = re.match(r'#\s*hash:\s*(\S+)', line)
+        if match:
+            return match.group(1).lower()
+    return None
+
+
+def guess_algorithm(path, digest, header=None):
+    """hash by header or name of checksum file, or by length of digest"""
+    if header is not None:
+        if header not in ALGORITHMS:
+            raise ValueError('Unknown hash "%s" in header of %s' % (header, path))
+        return header
+    for algorithm, name in SUM_FILES.items():
+        if os.path.basename(path) == name:
+            return algorithm
+    algorithms = DIGEST_SIZES.get(len(digest), [])
+    if len(algorithms) > 1:
+        raise ValueError('Digest of %s may be %s, use "--hash"' % (path, ' or '.join(algorithms)))
+    return algorithms[0] if algorithms else None
+
+
+def hash_path(path, size, algorithm):
+    """run in process of pool"""
+    return hash_file(path, size, algorithm).hexdigest()
+
+
+def verify_manifest(path, algorithm=None, depth=None):
+    """hash files in checksum file "path" again, return count of failed files.
+
+    Name is relative to directory of checksum file. Files are hashed in
+    process pool, "depth" files are read at once.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8', newline='\n') as f:
+        header = read_header(f)
+        f.seek(0)
+        sums = list(read_sums(f))
+    if not sums:
+        logger.error('No digest in %s' % path)
+        return 0
+    algorithm = algorithm or guess_algorithm(path, sums[0][0], header)
+    if algorithm in (None, 'none'):
+        raise ValueError('Unknown hash of %s, use "--hash"' % path)
+    depth = depth or io_depth(directory)
+    logger.info('Verify %s files by %s, %s files at once' % (len(sums), algorithm, depth))
+
+    failed = 0
+    entries = []
+    total_size = 0
+    for digest, name in sums:
+        file_path = os.path.join(directory, name.replace('/', os.sep))
+        try:
+            size = os.path.getsize(file_path)
+        except OSError as err:
+            logger.error('%s: FAILED open or read, %s' % (name, err.strerror))
+            failed += 1
+            continue
+        entries.append((digest, name, file_path, size))
+        total_size += size
+
+    bar = tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=min(depth, VERIFY_WORKERS)) as executor:
+        entries = iter(entries)
+        while True:
+            # keep queue of files for depth of storage
+            for digest, name, file_path, size in entries:
+                pending.append((digest, name, size, executor.submit(hash_path, file_path, size, algorithm)))
+                if len(pending) >= depth * 2:
+                    break
+            if not pending:
+                break
+            digest, name, size, future = pending.popleft()
+            try:
+                ok = future.result() == digest
+            except OSError as err:
+                bar.write('%s: FAILED open or read, %s' % (name, err.strerror), file=sys.stderr)
+                ok = None
+            if ok is False:
+                bar.write('%s: FAILED' % name, file=sys.stderr)
+            if not ok:
+                failed += 1
+            bar.update(size)
+    bar.close()
+    if failed:
+        logger.error('%s of %s files FAILED' % (failed, len(sums)))
+    else:
+        logger.info('All %s files OK' % len(sums))
+    return failed
@@ -0,0 +1,34 @@
+"""ndrop receiver in threads of test process"""
+import os
+import tempfile
+import threading
+import unittest
+
+from ndrop.netdrop import NetDropServer
+
+
+class ReceiverTestCase(unittest.TestCase):
+    """receiver of "mode" saves to "out_dir", sender sends from "src_dir" """
+    mode = 'dukto'
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix='ndrop-test-')
+        self.src_dir = os.path.join(self._tmp.name, 'src')
+        self.out_dir = os.path.join(self._tmp.name, 'out')
+        os.makedirs(self.src_dir)
+        os.makedirs(os.path.join(self.out_dir, 'src'))
+        self.server = NetDropServer('127.0.0.1:0:0', mode=self.mode)
+        self.server.saved_to(self.out_dir)
+        transport = self.server._transport[0]
+        self.tcp_server = transport._tcp_server
+        self._servers = [transport._tcp_server, transport._udp_server]
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addr = '127.0.0.1:%s:%s' % (
+            transport._tcp_server.server_address[1], transport._udp_server.server_address[1])
+
+    def tearDown(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._tmp.cleanup()
@@ -0,0 +1,227 @@
+"""policy of file changed when send, same result on every send path.
+
+$ python3 -m pytest tests
+"""
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from ndrop import dukto
+from ndrop import nitroshare
+from ndrop.fanout import Peer, send_fanout
+from ndrop.manifest import Manifest
+from ndrop.transport import RecvBuffer, file_changed
+
+
+LARGE_SIZE = 1024 * 1024 * 2 + 1234
+SMALL_SIZE = 1000
+
+
+class SendAgent(object):
+    """upper level of sender"""
+    _read_size = 1024 * 64
+
+    def __init__(self, policy):
+        self.policy = policy
+
+    def file_changed(self, name, size, new_size):
+        return file_changed(self.policy, name, size, new_size)
+
+    def send_feed_file(self, path, data, send_size, file_size, total_send_size, total_size):
+        pass
+
+    def send_feed_files(self, files, total_send_size, total_size):
+        pass
+
+    def send_finish_file(self, path):
+        pass
+
+    def send_finish(self, err):
+        pass
+
+
+class RecvAgent(object):
+    """collect data of every file"""
+    def __init__(self):
+        self.files = {}
+
+    def recv_feed_file(self, path, data, recv_size, file_size, total_recv_size, total_size, from_addr):
+        chunks = data if isinstance(data, list) else [data or b'']
+        for chunk in chunks:
+            self.files.setdefault(path, bytearray()).extend(chunk)
+
+    def recv_finish_file(self, path, from_addr):
+        pass
+
+
+def unpack(packet, stream):
+    agent = RecvAgent()
+    buff = RecvBuffer()
+    buff.extend(stream)
+    packet.unpack_tcp(agent, buff, ('127.0.0.1', 0))
+    return {name: bytes(data) for name, data in agent.files.items()}
+
+
+def send_socket(send):
+    """return data sent to socket by "send(sock)" """
+    sock, peer = socket.socketpair()
+    data = bytearray()
+
+    def drain():
+        buff = bytearray(1024 * 1024)
+        while True:
+            num = peer.recv_into(buff)
+            if not num:
+                break
+            data.extend(buff[:num])
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+    try:
+        send(sock)
+        sock.shutdown(socket.SHUT_WR)
+        reader.join()
+    finally:
+        sock.close()
+        peer.close()
+    return bytes(data)
+
+
+class FakeTransport(object):
+    """transport of fanout peer, collect stream items"""
+    def __init__(self):
+        self.files = {}
+
+    def send_stream(self, total_size, count, items):
+        for name, size, chunk in items:
+            data = self.files.setdefault(name, bytearray())
+            if chunk is not None:
+                data.extend(chunk)
+
+    def abort(self):
+        pass
+
+
+class ChangePolicyTest(unittest.TestCase):
+    """file in manifest is "size", but it is grown or shrunk before send"""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix='ndrop-test-')
+        self.tmp_dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def make_file(self, name, size, real_size):
+        path = os.path.join(self.tmp_dir, name)
+        data = os.urandom(real_size)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return (path, name, size), data
+
+    def expected(self, policy, size, data):
+        if policy == 'skip':
+            return bytes(size)
+        return data[:size] + bytes(max(size - len(data), 0))
+
+    def cases(self):
+        for policy in ['truncate', 'skip']:
+            for size in [SMALL_SIZE, LARGE_SIZE]:
+                for real_size in [size - 100, size + 100]:
+                    yield policy, size, real_size
+
+    def check(self, send):
+        """send(policy, files) return {name: data}"""
+        for policy, size, real_size in self.cases():
+            with self.subTest(policy=policy, size=size, real_size=real_size):
+                item, data = self.make_file('f_%s_%s' % (size, real_size), size, real_size)
+                files = [item]
+                received = send(policy, files)
+                self.assertEqual(received[item[1]], self.expected(policy, size, data))
+
+    def client(self, cls, policy):
+        client = cls(SendAgent(policy), '127.0.0.1')
+        client.set_change_policy(policy)
+        return client
+
+    def test_dukto_generator(self):
+        def send(policy, files):
+            client = self.client(dukto.DuktoClient, policy)
+            total_size = sum(size for _, _, size in files)
+            stream = bytearray(client._packet.pack_files_header(len(files), total_size))
+            for chunk in client._packet.pack_files(client, total_size, files):
+                stream.extend(chunk)
+            return unpack(dukto.DuktoPacket(), stream)
+        self.check(send)
+
+    def test_dukto_sendfile(self):
+        def send(policy, files):
+            client = self.client(dukto.DuktoClient, policy)
+            total_size = sum(size for _, _, size in files)
+            header = client._packet.pack_files_header(len(files), total_size)
+
+            def sendfile(sock):
+                sock.sendall(header)
+                client.sendfile_files(sock, total_size, files)
+            return unpack(dukto.DuktoPacket(), send_socket(sendfile))
+        self.check(send)
+
+    def test_nitroshare_generator(self):
+        def send(policy, files):
+            client = self.client(nitroshare.NitroshareClient, policy)
+            total_size = sum(size for _, _, size in files)
+            stream = bytearray(client._packet.pack_files_header('test', total_size, len(files)))
+            for chunk in client._packet.pack_files(client, total_size, files):
+                stream.extend(chunk)
+            return unpack(nitroshare.Packet(), stream)
+        self.check(send)
+
+    def test_nitroshare_sendmsg(self):
+        def send(policy, files):
+            client = self.client(nitroshare.NitroshareClient, policy)
+            total_size = sum(size for _, _, size in files)
+            header = client._packet.pack_files_header('test', total_size, len(files))
+
+            def sendmsg(sock):
+                sock.sendall(header)
+                client.sendmsg_files(sock, total_size, files)
+            return unpack(nitroshare.Packet(), send_socket(sendmsg))
+        self.check(send)
+
+    def test_fanout(self):
+        def send(policy, files):
+            manifest = Manifest()
+            for path, name, size in files:
+                manifest.append(path, len(path) - len(name), size)
+            transport = FakeTransport()
+            peer = Peer('test', transport, manifest.total_size, len(manifest))
+            send_fanout(SendAgent(policy), [peer], manifest, 1024 * 64)
+            return transport.files
+        self.check(send)
+
+    def test_resume_generator(self):
+        # file is sent from offset, "size" is size of whole file
+        offset = 1000
+
+        def send(policy, files):
+            client = self.client(dukto.DuktoClient, policy)
+            offsets = {name: offset for _, name, _ in files}
+            total_size = sum(size - offset for _, _, size in files)
+            stream = bytearray(client._packet.pack_files_header(len(files), total_size))
+            for chunk in client._packet.pack_files(client, total_size, files, offsets):
+                stream.extend(chunk)
+            received = unpack(dukto.DuktoPacket(), stream)
+            return {name: bytes(offset) + data for name, data in received.items()}
+
+        for policy, size, real_size in self.cases():
+            with self.subTest(policy=policy, size=size, real_size=real_size):
+                item, data = self.make_file('r_%s_%s' % (size, real_size), size, real_size)
+                received = send(policy, [item])
+                expected = self.expected(policy, size, data)
+                self.assertEqual(received[item[1]][offset:], expected[offset:])
+
+
+if __name__ == '__main__':
+    unittest.main()
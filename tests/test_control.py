@@ -0,0 +1,47 @@
+"""control connection of ndrop sender, broken in message.
+
+$ python3 -m pytest tests
+"""
+import sys
+import socket
+import threading
+import unittest
+
+from ndrop.transport import CONTROL_MAGIC, MESSAGE_SIZE
+
+from receiver import ReceiverTestCase
+
+
+class ControlTest(ReceiverTestCase):
+    def close_in_message(self):
+        """return errors of handler, connection is closed before message is complete"""
+        errors = []
+        done = threading.Event()
+        shutdown_request = self.tcp_server.shutdown_request
+
+        def handle_error(request, client_address):
+            errors.append(sys.exc_info()[1])
+
+        def on_shutdown(request):
+            shutdown_request(request)
+            done.set()
+
+        self.tcp_server.handle_error = handle_error
+        self.tcp_server.shutdown_request = on_shutdown
+        sock = socket.create_connection(self.tcp_server.server_address)
+        sock.sendall(CONTROL_MAGIC + MESSAGE_SIZE.pack(100) + b'{"op": ')
+        sock.close()
+        self.assertTrue(done.wait(5))
+        return errors
+
+    def test_close_in_message(self):
+        self.assertEqual(self.close_in_message(), [])
+        self.assertEqual(self.server._sessions, {})
+
+
+class NitroshareControlTest(ControlTest):
+    mode = 'nitroshare'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""resume partial file between ndrop sender and receiver.
+
+$ python3 -m pytest tests
+"""
+import os
+import json
+import time
+import hashlib
+import unittest
+from unittest import mock
+
+from ndrop import netdrop
+from ndrop.netdrop import NetDropClient, JOURNAL_NAME, part_path
+
+from receiver import ReceiverTestCase
+
+
+FILE_SIZE = 1024 * 1024 * 24
+WRITTEN = 1024 * 1024 * 4
+# timeout of data connection of sender, hash of written data takes longer
+SEND_TIMEOUT = 0.5
+HASH_DELAY = SEND_TIMEOUT * 4
+
+
+class ResumeTest(ReceiverTestCase):
+    def make_partial(self, name):
+        """file of sender, and part of it written by receiver"""
+        data = os.urandom(FILE_SIZE)
+        with open(os.path.join(self.src_dir, name), 'wb') as f:
+            f.write(data)
+        with open(part_path(os.path.join(self.out_dir, 'src', name)), 'wb') as f:
+            f.write(data[:WRITTEN])
+        journal = {'src/%s' % name: {
+            'size': FILE_SIZE,
+            'written': WRITTEN,
+            'hash': 'md5',
+            'digest': hashlib.md5(data[:WRITTEN]).hexdigest(),
+        }}
+        with open(os.path.join(self.out_dir, JOURNAL_NAME), 'w') as f:
+            json.dump(journal, f)
+        return data
+
+    def test_slow_hash_of_written_data(self):
+        data = self.make_partial('big.bin')
+        hash_file = netdrop.hash_file
+
+        def slow_hash_file(path, size, algorithm='md5'):
+            if path.endswith(netdrop.PART_SUFFIX):
+                time.sleep(HASH_DELAY)
+            return hash_file(path, size, algorithm)
+
+        client = NetDropClient(self.addr, mode='dukto', resume=True)
+        client._transport._timeout = SEND_TIMEOUT
+        with mock.patch.object(netdrop, 'hash_file', slow_hash_file):
+            client.send_files([self.src_dir])
+
+        path = os.path.join(self.out_dir, 'src', 'big.bin')
+        for _ in range(50):     # receiver may still write
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        self.assertEqual(client._offsets, {'src/big.bin': WRITTEN})
+        with open(path, 'rb') as f:
+            self.assertTrue(f.read() == data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""hash of checksum file for "--verify".
+
+$ python3 -m pytest tests
+"""
+import os
+import tempfile
+import unittest
+
+from ndrop.digest import SUM_HEADER, new_hash, sum_line
+from ndrop.verify import guess_algorithm, verify_manifest
+
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix='ndrop-test-')
+        self.tmp_dir = self._tmp.name
+        self.data = os.urandom(1024 * 1024 * 3 + 1000)
+        with open(os.path.join(self.tmp_dir, 'a.bin'), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write_sums(self, name, algorithm, header=True):
+        hash_obj = new_hash(algorithm)
+        hash_obj.update(self.data)
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            if header:
+                f.write(SUM_HEADER % algorithm + '\n')
+            f.write(sum_line(hash_obj.hexdigest(), 'a.bin') + '\n')
+        return path
+
+    def test_renamed_tree_sums(self):
+        path = self.write_sums('sums.txt', 'tree')
+        self.assertEqual(verify_manifest(path, depth=1), 0)
+
+    def test_name_of_sums(self):
+        path = self.write_sums('B2TREESUMS', 'tree', header=False)
+        self.assertEqual(verify_manifest(path, depth=1), 0)
+
+    def test_ambiguous_digest(self):
+        path = self.write_sums('sums.txt', 'tree', header=False)
+        with self.assertRaises(ValueError):
+            verify_manifest(path, depth=1)
+        self.assertEqual(verify_manifest(path, algorithm='tree', depth=1), 0)
+        self.assertEqual(guess_algorithm(path, '0' * 32), 'md5')
+
+
+if __name__ == '__main__':
+    unittest.main()